@@ -22,25 +22,94 @@ from .core import RockerExtensionManager
 from .core import DependencyMissing
 from .core import ExtensionError
 from .core import base_image_exists
+from .core import load_manifest
+from .core import record_config_usage
+from .core import run_manifest
+from .core import write_manifest
+from .core import BUILD_BACKEND_BUILDKIT
 from .core import OPERATIONS_DRY_RUN
 from .core import OPERATIONS_INTERACTIVE
 from .core import OPERATIONS_NON_INTERACTIVE
+from .core import OPERATIONS_RENDER
 from .core import OPERATION_MODES
 
+from .image_gc import parse_age
 from .os_detector import detect_os
 
 
+DEFAULT_MANIFEST = 'rocker_manifest.json'
+
+
 def main():
+    if sys.argv[1:2] == ['gc']:
+        from .image_gc import main as gc_main
+        return gc_main(sys.argv[2:])
+    if sys.argv[1:2] == ['build']:
+        return build_main(sys.argv[2:])
+    if sys.argv[1:2] == ['run']:
+        return run_main(sys.argv[2:])
+
+    parser, extension_manager = create_parser(
+        description='A tool for running docker with extra options. '
+        'See `rocker build --help` and `rocker run --help` for building an image once and running it many times '
+        'and `rocker gc --help` for removing images built by rocker.')
+    args = parser.parse_args()
+    args_dict = vars(args)
+
+    active_extensions = get_active_extensions(parser, extension_manager, args_dict)
+    if active_extensions is None:
+        return 1
+
+    base_image = args.image
 
+    if args_dict['mode'] == OPERATIONS_RENDER:
+        args.command = ' '.join(args.command)
+        try:
+            dig = DockerImageGenerator(active_extensions, args_dict, base_image)
+            return dig.render(**args_dict)
+        except DependencyMissing as ex:
+            requiring = [e.get_name() for e in active_extensions if getattr(e, 'render_requires_daemon', False)]
+            print(f"ERROR! Rendering with the extensions {requiring} requires the docker daemon: {ex}")
+            return 1
+
+    check_base_image(parser, base_image)
+
+    dig = DockerImageGenerator(active_extensions, args_dict, base_image)
+    exit_code = dig.build(**vars(args))
+    if exit_code != 0:
+        print("Build failed exiting")
+        if not (args_dict['persist_image'] or args_dict.get('image_name')):
+            dig.clear_image()
+        return exit_code
+    # Convert command into string
+    args.command = ' '.join(args.command)
+    result = dig.run(**args_dict)
+    if not (args_dict['persist_image'] or args_dict.get('image_name')):
+        retain_repeated_image(dig, args_dict)
+        if not (dig.base_image_only or dig.cached):
+            print(f'Clearing Image: {dig.image_id}\nTo not clean up use --persist-image')
+        dig.clear_image()
+    return result
+
+
+def create_parser(description, prog=None):
+    """Return an argument parser with the options of rocker and all extensions and the extension manager."""
     parser = argparse.ArgumentParser(
-        description='A tool for running docker with extra options',
+        prog=prog,
+        description=description,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('image')
     parser.add_argument('command', nargs='*', default='')
-    parser.add_argument('--noexecute', action='store_true', help='Deprecated') # TODO(tfoote) add when 3.13 is minimum supported, deprecated=True 
+    parser.add_argument('--noexecute', action='store_true', help='Deprecated') # TODO(tfoote) add when 3.13 is minimum supported, deprecated=True
     parser.add_argument('--nocache', action='store_true')
     parser.add_argument('--nocleanup', action='store_true', help='do not remove the docker container when stopped')
     parser.add_argument('--persist-image', action='store_true', help='do not remove the docker image when stopped', default=False) #TODO(tfoote) Add a name to it if persisting
+    parser.add_argument('--image-cache', action='store_true', help='reuse a previously built image if the generated configuration is identical, cached images are not removed after the run')
+    parser.add_argument('--retain-repeated', type=int, default=None, metavar='N',
+        help='remove the image after the run unless the same configuration was run at least N times within --retain-window, '
+        'retained images are reused like with --image-cache')
+    parser.add_argument('--retain-window', type=parse_age, default='7d',
+        help='period in which runs of a configuration are counted for --retain-repeated, e.g. 12h or 7d')
     parser.add_argument('--pull', action='store_true')
     parser.add_argument('--version', action='version',
         version='%(prog)s ' + get_rocker_version())
@@ -52,15 +121,18 @@ def main():
     except DependencyMissing as ex:
         # Catch errors if docker is missing or inaccessible.
         parser.error(str(ex))
+    return parser, extension_manager
 
-    args = parser.parse_args()
-    args_dict = vars(args)
 
-    if args.noexecute:
-        from .core import OPERATIONS_DRY_RUN
+def get_active_extensions(parser, extension_manager, args_dict):
+    """Validate the parsed arguments and return the active extensions or None on failure."""
+    if args_dict.get('retain_repeated') is not None and args_dict['retain_repeated'] < 1:
+        parser.error("--retain-repeated must be at least 1")
+
+    if args_dict.get('noexecute'):
         args_dict['mode'] = OPERATIONS_DRY_RUN
         print('DEPRECATION Warning: --noexecute is deprecated for --mode dry-run please switch your usage by December 2020')
-    
+
     # validate_operating_mode
     operating_mode = args_dict.get('mode')
     # Don't try to be interactive if there's no tty
@@ -70,7 +142,7 @@ def main():
         elif not operating_mode:
             print("No tty detected for stdin defaulting mode to non-interactive")
             args_dict['mode'] = OPERATIONS_NON_INTERACTIVE
-    
+
     # Check if detach extension is active and deconflict with interactive
     detach_active = args_dict.get('detach')
     operating_mode = args_dict.get('mode')
@@ -84,6 +156,10 @@ def main():
     # Right now the printed results will include '-it'
     # But based on testing the --detach overrides -it in docker so it's ok.
 
+    if args_dict.get('apt_cache') and args_dict.get('build_backend') != BUILD_BACKEND_BUILDKIT:
+        print(f"Apt cache mounts require BuildKit, using build backend {BUILD_BACKEND_BUILDKIT}")
+        args_dict['build_backend'] = BUILD_BACKEND_BUILDKIT
+
     # Default to interactive if unset
     if args_dict.get('mode') not in OPERATION_MODES:
         print("Mode unset, defaulting to interactive")
@@ -93,7 +169,7 @@ def main():
         active_extensions = extension_manager.get_active_extensions(args_dict)
     except ExtensionError as e:
         print(f"ERROR! {str(e)}")
-        return 1
+        return None
     print("Active extensions %s" % [e.get_name() for e in active_extensions])
 
     # Give active extensions a chance to validate the arguments
@@ -106,10 +182,10 @@ def main():
             traceback.print_exc()
             print("DEPRECATION WARNING: validation of the environment not successfully acomplished, but continuing. Please fix your implmentation similar to https://github.com/osrf/rocker/pull/350"
                   " This warning will be maintained until at least Jan 2027. On removal it will cause a traceback.")
+    return active_extensions
 
 
-    base_image = args.image
-
+def check_base_image(parser, base_image):
     # Check if base image exists before proceeding (will attempt to pull if missing)
     try:
         if not base_image_exists(base_image, output_callback=print):
@@ -117,20 +193,95 @@ def main():
     except DependencyMissing as ex:
         parser.error(f"DependencyMissing encountered: {ex}")
 
+
+def retain_repeated_image(dig, args_dict):
+    """Keep the image of a configuration run repeatedly as requested by --retain-repeated."""
+    retain_repeated = args_dict.get('retain_repeated')
+    if not retain_repeated or not dig.config_hash or dig.base_image_only:
+        return
+    runs = record_config_usage(dig.config_hash, args_dict['retain_window'])
+    if dig.cached:
+        return
+    if runs >= retain_repeated:
+        print(f"Configuration {dig.config_hash[:12]} ran {runs} times within the retention window, keeping the image")
+        dig.retain_image()
+
+
+def build_main(argv=None):
+    parser, extension_manager = create_parser(
+        prog='rocker build',
+        description='Build and tag an image like rocker would and write a manifest for running it with `rocker run`. '
+        'Without --image-name the image is tagged rocker-cache:<hash>.')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+        help='file to write the image reference and docker arguments to')
+    args = parser.parse_args(argv)
+    args_dict = vars(args)
+    if args_dict.get('mode') == OPERATIONS_RENDER:
+        parser.error("rocker build does not support --mode render, use rocker --mode render instead")
+    # Files created for the docker arguments, such as the user mapping, must outlive this process
+    args_dict['nocleanup'] = True
+
+    active_extensions = get_active_extensions(parser, extension_manager, args_dict)
+    if active_extensions is None:
+        return 1
+
+    base_image = args.image
+    check_base_image(parser, base_image)
+
     dig = DockerImageGenerator(active_extensions, args_dict, base_image)
-    exit_code = dig.build(**vars(args))
+    exit_code = dig.build(**args_dict)
     if exit_code != 0:
         print("Build failed exiting")
-        if not (args_dict['persist_image'] or args_dict.get('image_name')):
+        if not args_dict.get('image_name'):
             dig.clear_image()
         return exit_code
-    # Convert command into string
-    args.command = ' '.join(args.command)
-    result = dig.run(**args_dict)
-    if not (args_dict['persist_image'] or args_dict.get('image_name')):
-        print(f'Clearing Image: {dig.image_id}s\nTo not clean up use --persist-image')
-        dig.clear_image()
-    return result
+
+    if args_dict.get('image_name'):
+        image = args_dict['image_name']
+    elif dig.base_image_only:
+        image = base_image
+    else:
+        dig.retain_image()
+        image = dig.get_cache_tag()
+
+    if not dig.precondition_environment():
+        return 1
+    write_manifest(dig.get_manifest(image, ' '.join(args.command)), args.manifest)
+    print(f"Wrote manifest {args.manifest} for image {image}, run it with `rocker run --manifest {args.manifest}`")
+    return 0
+
+
+def run_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='rocker run',
+        description='Run an image built by `rocker build` from its manifest. '
+        'The Dockerfile is not generated again and extensions are not invoked.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+        help='manifest written by rocker build')
+    parser.add_argument('command', nargs='*', default='',
+        help='command to run instead of the one given to rocker build')
+    parser.add_argument('--mode', choices=[OPERATIONS_INTERACTIVE, OPERATIONS_NON_INTERACTIVE, OPERATIONS_DRY_RUN],
+        help='mode of operation, defaults to the mode of rocker build')
+    parser.add_argument('--nocleanup', action='store_true', help='do not remove the docker container when stopped')
+    args = parser.parse_args(argv)
+
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError) as ex:
+        parser.error(f"Failed to read manifest: {ex}")
+
+    operating_mode = args.mode or manifest.get('mode')
+    if operating_mode not in OPERATION_MODES or operating_mode == OPERATIONS_RENDER:
+        operating_mode = OPERATIONS_INTERACTIVE
+    # Don't try to be interactive if there's no tty
+    if operating_mode == OPERATIONS_INTERACTIVE and not os.isatty(sys.__stdin__.fileno()):
+        if args.mode:
+            parser.error("No tty detected cannot operate in interactive mode")
+        print("No tty detected for stdin defaulting mode to non-interactive")
+        operating_mode = OPERATIONS_NON_INTERACTIVE
+
+    return run_manifest(manifest, ' '.join(args.command), mode=operating_mode, nocleanup=args.nocleanup)
 
 
 def detect_image_os():
@@ -139,7 +290,7 @@ def detect_image_os():
     parser.add_argument('--verbose', action='store_true',
         help='Display verbose output of the process')
 
-    args = parser.parse_args()    
+    args = parser.parse_args()
 
     results = detect_os(args.image, print if args.verbose else None)
     print(results)
@@ -13,42 +13,76 @@
 # limitations under the License.
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from contextlib import nullcontext
+import hashlib
+import heapq
+import importlib.util
 import io
+import json
 import os
+import posixpath
 import pwd
 import re
 import sys
 
-# importlib-metadata dependency can be removed when RHEL8 and other 3.6 based systems are not in support cycles
-if sys.version_info >= (3, 8):
-    import importlib.metadata as importlib_metadata
-else:
-    import importlib_metadata
-
 
 import pkgutil
-from requests.exceptions import ConnectionError
 import shlex
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+import weakref
 
-import docker
-import pexpect
+# docker, pexpect and the terminal handling modules are imported where they are
+# used so that importing rocker.core stays cheap for API users.
 
-import fcntl
 from pathlib import Path
-import signal
-import struct
-import termios
 import typing
 
+from .dockerfile import as_text
+from .dockerfile import join_instructions
+from .dockerfile import optimize
+from .dockerfile import render_dockerfile
+
 SYS_STDOUT = sys.stdout
 
 OPERATIONS_DRY_RUN = 'dry-run'
 OPERATIONS_NON_INTERACTIVE = 'non-interactive'
 OPERATIONS_INTERACTIVE = 'interactive'
-OPERATION_MODES = [OPERATIONS_INTERACTIVE, OPERATIONS_NON_INTERACTIVE , OPERATIONS_DRY_RUN]
+OPERATIONS_RENDER = 'render'
+OPERATION_MODES = [OPERATIONS_INTERACTIVE, OPERATIONS_NON_INTERACTIVE , OPERATIONS_DRY_RUN, OPERATIONS_RENDER]
+
+IMAGE_CACHE_REPOSITORY = 'rocker-cache'
+
+# Labels of the images built by rocker
+LABEL_CONFIG_HASH = 'rocker.config_hash'
+LABEL_BUILT_AT = 'rocker.built_at'
+
+BUILD_BACKEND_LEGACY = 'legacy'
+BUILD_BACKEND_BUILDKIT = 'buildkit'
+BUILD_BACKENDS = [BUILD_BACKEND_LEGACY, BUILD_BACKEND_BUILDKIT]
+
+# How likely the output of an extension is to differ between builds
+VOLATILITY_STABLE = 0  # Identical for all hosts and users
+VOLATILITY_HOST = 1  # Depends on the build host
+VOLATILITY_USER = 2  # Depends on the invoking user
+
+EXTENSION_ORDERING_ALPHABETICAL = 'alphabetical'
+EXTENSION_ORDERING_CACHE = 'cache'
+EXTENSION_ORDERINGS = [EXTENSION_ORDERING_ALPHABETICAL, EXTENSION_ORDERING_CACHE]
+
+# Whether the user extension creates the user in the image or when the container starts
+USER_MAPPING_BUILD = 'build'
+USER_MAPPING_RUNTIME = 'runtime'
+USER_MAPPINGS = [USER_MAPPING_BUILD, USER_MAPPING_RUNTIME]
+
+
+# Hooks whose results the core computes once per extension instance and cliargs
+MEMOIZED_HOOKS = ('get_preamble', 'get_snippet', 'get_user_snippet', 'get_docker_args', 'get_apt_packages')
+_hook_results = weakref.WeakKeyDictionary()
 
 
 class DependencyMissing(RuntimeError):
@@ -62,6 +96,20 @@ class ExtensionError(RuntimeError):
 class RockerExtension(object):
     """The base class for Rocker extension points"""
 
+    # Set to False if register_arguments depends on runtime state such that the
+    # registered arguments cannot be cached between invocations.
+    cacheable_arguments = True
+
+    # Set to False if the results of the MEMOIZED_HOOKS may change for the same
+    # cliargs, for example because they depend on precondition_environment.
+    memoize_hooks = True
+
+    # Set to True if generating the Dockerfile or docker arguments needs the
+    # docker daemon even in render mode, for example to inspect the base image.
+    # Other extensions must not touch the daemon or the host when the mode is
+    # OPERATIONS_RENDER.
+    render_requires_daemon = False
+
     def precondition_environment(self, cliargs):
         """Modify the local environment such as setup tempfiles"""
         pass
@@ -81,6 +129,15 @@ class RockerExtension(object):
         """
         return set()
 
+    def get_volatility(self, cliargs):
+        """
+        How likely the image content of this extension is to change between
+        builds, one of VOLATILITY_STABLE, VOLATILITY_HOST or VOLATILITY_USER.
+        With the cache extension ordering less volatile extensions are placed
+        first so their layers can be shared between hosts and users.
+        """
+        return VOLATILITY_HOST
+
     def required(self, cliargs) -> typing.Set[str]:
         """
         Ensures the specified extensions are present and combined with
@@ -104,6 +161,13 @@ class RockerExtension(object):
         """Get a dict of local filenames and content to write into them"""
         return {}
 
+    def get_apt_packages(self, cliargs):
+        """Get a list of apt packages to install as ROOT before any snippets run.
+
+        The packages of all active extensions are installed together in a single
+        apt transaction. Packages already installed in the base image are skipped."""
+        return []
+
     @staticmethod
     def get_name():
         raise NotImplementedError
@@ -139,12 +203,27 @@ class RockerExtensionManager:
                 print("Extension %s doesn't support default arguments. Please extend it." % p.get_name())
                 p.register_arguments(parser)
         parser.add_argument('--mode', choices=OPERATION_MODES,
-            help="Choose mode of operation for rocker, default interactive unless detached.")
+            help="Choose mode of operation for rocker, default interactive unless detached. "
+            "render prints the Dockerfile, files and run command without building, "
+            "it only needs the docker daemon for extensions inspecting the base image such as nvidia and cuda.")
         parser.add_argument('--image-name', default=None,
             help='Tag the final image, useful with dry-run')
+        parser.add_argument('--build-backend', choices=BUILD_BACKENDS, default=BUILD_BACKEND_LEGACY,
+            help='Build with the legacy builder through the docker API or with BuildKit through `docker buildx`. '
+            'BuildKit builds independent stages in parallel and supports RUN --mount.')
+        parser.add_argument('--apt-cache', action='store_true',
+            help='Keep apt package lists and archives in persistent BuildKit cache mounts '
+            'shared between builds of the same base image. Implies --build-backend buildkit.')
+        parser.add_argument('--optimize-dockerfile', action='store_true',
+            help='Merge adjacent RUN and ENV instructions and drop duplicate ARG and COPY --from '
+            'instructions of the generated Dockerfile to reduce the number of layers.')
         parser.add_argument('--extension-blacklist', nargs='*',
             default=[],
             help='Prevent any of these extensions from being loaded.')
+        parser.add_argument('--extension-ordering', choices=EXTENSION_ORDERINGS,
+            default=EXTENSION_ORDERING_ALPHABETICAL,
+            help='Order of the extension snippets in the Dockerfile within the constraints of their dependencies. '
+            'cache places stable extensions before host and user specific ones to maximize layer reuse.')
         parser.add_argument('--strict-extension-selection', action='store_true',
             help='When enabled, causes an error if required extensions are not explicitly '
             'called out on the command line. Otherwise, the required extensions will '
@@ -180,8 +259,34 @@ class RockerExtensionManager:
                     pending = next_pending
                     emitted = next_emitted
 
+            def volatility_sort(source: typing.Dict[str, typing.Set[str]]) -> typing.List[str]:
+                """Perform a topological sort emitting the least volatile available extension first."""
+                pending = {name: dependencies.intersection(source.keys()) for name, dependencies in source.items()}
+                dependents = {name: set() for name in source}
+                for name, dependencies in pending.items():
+                    for dependency in dependencies:
+                        dependents[dependency].add(name)
+                ready = [(extensions[name].get_volatility(cli_args), name) for name, deps in pending.items() if not deps]
+                heapq.heapify(ready)
+                emitted = []
+                while ready:
+                    _, name = heapq.heappop(ready)
+                    emitted.append(name)
+                    for dependent in dependents[name]:
+                        pending[dependent].discard(name)
+                        if not pending[dependent]:
+                            heapq.heappush(ready, (extensions[dependent].get_volatility(cli_args), dependent))
+                if len(emitted) != len(source):
+                    raise ExtensionError("Cyclic dependancy detected: %r" % (
+                        [(name, deps) for name, deps in pending.items() if deps],))
+                return emitted
+
             extension_graph = {name: cls.invoke_after(cli_args) for name, cls in sorted(extensions.items())}
-            active_extension_list = [extensions[name] for name in topological_sort(extension_graph)]
+            if cli_args.get('extension_ordering') == EXTENSION_ORDERING_CACHE:
+                sorted_names = volatility_sort(extension_graph)
+            else:
+                sorted_names = topological_sort(extension_graph)
+            active_extension_list = [extensions[name] for name in sorted_names]
             return active_extension_list
 
         active_extensions = {}
@@ -210,8 +315,34 @@ class RockerExtensionManager:
 
         return sort_extensions(active_extensions, cli_args)
 
+_docker_client = None
+_docker_client_lock = threading.Lock()
+
+def set_docker_client(docker_client):
+    """Set the docker API client used by rocker for the rest of the process.
+
+    This allows API users to inject a preconfigured client. Pass None to drop
+    the current client so a new one is created on next use."""
+    global _docker_client
+    with _docker_client_lock:
+        _docker_client = docker_client
+
 def get_docker_client():
+    """Return the docker API client shared across the process.
+
+    The client is created and validated with a ping on first use. Reusing it
+    keeps the connection pool, and so the keep-alive connections, of the
+    underlying session for all requests of a run."""
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is None:
+            _docker_client = create_docker_client()
+        return _docker_client
+
+def create_docker_client():
     """Simple helper function for pre 2.0 imports"""
+    import docker
+    from requests.exceptions import ConnectionError
     try:
         try:
             docker_client = docker.from_env().api
@@ -261,15 +392,245 @@ def get_docker_client():
             "  - `docker ps` works\n\n"
             f"Original error: {ex}"
         )
+def get_cache_dir():
+    """Directory for rocker's persistent caches, following the XDG base directory spec."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'rocker')
+
+@contextmanager
+def json_cache(filename):
+    """Open a json file in the rocker cache directory for reading and updating.
+
+    The yielded dict holds the current content of the file. An exclusive lock
+    is held for the duration of the block so that concurrent rocker processes
+    don't lose each others updates. Modifications are written back atomically.
+    Raises OSError if the cache directory is not usable."""
+    cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, filename)
+    import fcntl
+    with open(cache_path + '.lock', 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            with open(cache_path, 'r') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            data = {}
+        original = json.dumps(data, sort_keys=True)
+        yield data
+        if json.dumps(data, sort_keys=True) != original:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.' + filename)
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(data, fh)
+            os.replace(tmp_path, cache_path)
+
+IMAGE_USAGE_CACHE_FILE = 'image_usage.json'
+# Seconds within which repeated uses of an image are recorded only once
+IMAGE_USAGE_RESOLUTION = 60
+
+def record_image_usage(image_id, config_hash=None):
+    """Remember that an image built by rocker was just used.
+
+    Image labels can't be changed after the build, so the last use is kept in
+    the rocker cache directory for `rocker gc`. Only images which outlive the
+    run should be recorded."""
+    now = time.time()
+    try:
+        with json_cache(IMAGE_USAGE_CACHE_FILE) as usage:
+            entry = usage.setdefault(image_id, {})
+            if now - entry.get('last_used', 0) >= IMAGE_USAGE_RESOLUTION:
+                entry['last_used'] = now
+            if config_hash:
+                entry['config_hash'] = config_hash
+    except OSError as ex:
+        print(f"Failed to record the usage of image {image_id}: {ex}")
+
+def get_image_usage():
+    """Return the last use of images built by rocker keyed by image id."""
+    try:
+        with json_cache(IMAGE_USAGE_CACHE_FILE) as usage:
+            return dict(usage)
+    except OSError:
+        return {}
+
+def forget_image_usage(image_ids):
+    try:
+        with json_cache(IMAGE_USAGE_CACHE_FILE) as usage:
+            for image_id in image_ids:
+                usage.pop(image_id, None)
+    except OSError:
+        pass
+
+CONFIG_USAGE_CACHE_FILE = 'config_usage.json'
+
+def record_config_usage(config_hash, window, now=None):
+    """Record a use of an image configuration and return how often it was
+    used within the last window seconds, including this use.
+
+    Uses older than the window are forgotten for all configurations."""
+    if now is None:
+        now = time.time()
+    try:
+        with json_cache(CONFIG_USAGE_CACHE_FILE) as usage:
+            usage.setdefault(config_hash, []).append(now)
+            for key in list(usage):
+                usage[key] = [t for t in usage[key] if now - t <= window]
+                if not usage[key]:
+                    del usage[key]
+            return len(usage.get(config_hash, []))
+    except OSError as ex:
+        print(f"Failed to record the usage of configuration {config_hash}: {ex}")
+        return 1
+
+DAEMON_INFO_CACHE_FILE = 'daemon_info.json'
+# Seconds after which facts about a docker daemon are queried again
+DAEMON_INFO_TTL = 3600
+
+_daemon_info = {}
+
+def get_daemon_info(docker_client=None, ttl=DAEMON_INFO_TTL):
+    """Return facts about the docker daemon for use by extensions.
+
+    The returned dict has the keys 'version', 'api_version', 'runtimes' and
+    'storage_driver'. Results are cached in memory and on disk per daemon
+    endpoint and refreshed after ttl seconds."""
+    if docker_client is None:
+        docker_client = get_docker_client()
+    endpoint = '%s %s' % (getattr(docker_client, 'base_url', ''), os.environ.get('DOCKER_HOST', ''))
+    now = time.time()
+    cached = _daemon_info.get(endpoint)
+    if cached is None:
+        try:
+            with json_cache(DAEMON_INFO_CACHE_FILE) as cache:
+                cached = cache.get(endpoint)
+        except OSError:
+            cached = None
+    if cached is not None and now - cached['timestamp'] < ttl:
+        _daemon_info[endpoint] = cached
+        return cached['info']
+
+    version = docker_client.version()
+    system_info = docker_client.info()
+    cached = {
+        'timestamp': now,
+        'info': {
+            'version': version['Version'],
+            'api_version': version.get('ApiVersion'),
+            'runtimes': sorted(system_info.get('Runtimes') or {}),
+            'storage_driver': system_info.get('Driver'),
+        }
+    }
+    _daemon_info[endpoint] = cached
+    try:
+        with json_cache(DAEMON_INFO_CACHE_FILE) as cache:
+            cache[endpoint] = cached
+    except OSError:
+        pass
+    return cached['info']
+
+def is_remote_daemon(docker_client):
+    """Return True if the client is not talking to the daemon over a local socket."""
+    base_url = getattr(docker_client, 'base_url', '')
+    return not base_url.startswith('http+docker://local')
+
+def get_apt_cache_mounts(cliargs):
+    """Return the RUN flags mounting persistent apt caches or '' if the apt cache is disabled.
+
+    Extensions should declare packages with get_apt_packages. Snippets which
+    still need to install packages themselves use this as
+    `RUN @(apt_cache_mounts)apt-get ...` and must not clean the package lists
+    or archives when it is set. The caches are BuildKit cache mounts keyed by base image so they are shared between
+    builds without ending up in the image."""
+    if not cliargs.get('apt_cache'):
+        return ''
+    cache_key = re.sub(r'[^A-Za-z0-9_.-]', '_', cliargs.get('base_image', 'default'))
+    return ('--mount=type=cache,id=rocker-apt-lists-%(key)s,target=/var/lib/apt/lists,sharing=locked '
+            '--mount=type=cache,id=rocker-apt-archives-%(key)s,target=/var/cache/apt,sharing=locked ' % {'key': cache_key})
+
+def get_apt_install_snippet(packages, cliargs):
+    """Return a RUN instruction installing the missing packages in one apt transaction.
+
+    Packages already installed are skipped so that no index refresh happens if
+    the base image provides everything. On images without apt-get a warning is
+    printed instead of failing the build."""
+    apt_cache_mounts = get_apt_cache_mounts(cliargs)
+    cleanup = 'true' if apt_cache_mounts else 'rm -rf /var/lib/apt/lists/*'
+    return ('RUN %(mounts)smissing_packages="" \\\n'
+            ' && for package in %(packages)s; do \\\n'
+            '      dpkg-query -W -f=\'${Status}\' "${package}" 2>/dev/null | grep -q "ok installed" || missing_packages="${missing_packages} ${package}"; \\\n'
+            '    done \\\n'
+            ' && if [ -z "${missing_packages}" ]; then \\\n'
+            '      echo "All requested apt packages are already installed"; \\\n'
+            '    elif ! command -v apt-get >/dev/null; then \\\n'
+            '      echo "WARNING apt-get not available, unable to install${missing_packages}"; \\\n'
+            '    else \\\n'
+            '      apt-get update \\\n'
+            '      && DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends ${missing_packages} \\\n'
+            '      && %(cleanup)s; \\\n'
+            '    fi\n' % {
+                'mounts': apt_cache_mounts,
+                'packages': ' '.join(packages),
+                'cleanup': cleanup})
+
+def call_extension_hook(extension, hook, cliargs):
+    """Return the result of calling the hook of the extension with cliargs.
+
+    Results of the MEMOIZED_HOOKS are remembered for the extension instance and
+    a snapshot of cliargs unless the extension sets memoize_hooks to False.
+    The docker arguments of extensions with a precondition_environment are not
+    remembered as they usually refer to the files it creates for each run."""
+    if hook not in MEMOIZED_HOOKS or not getattr(extension, 'memoize_hooks', True):
+        return getattr(extension, hook)(cliargs)
+    if hook == 'get_docker_args' and \
+            getattr(type(extension), 'precondition_environment', None) is not RockerExtension.precondition_environment:
+        return getattr(extension, hook)(cliargs)
+    try:
+        key = (hook, repr(sorted(cliargs.items())))
+        results = _hook_results.setdefault(extension, {})
+    except TypeError:
+        # Not sortable cliargs or an extension which cannot be weakly referenced
+        return getattr(extension, hook)(cliargs)
+    if key not in results:
+        results[key] = getattr(extension, hook)(cliargs)
+    return results[key]
+
 def get_user_name():
     userinfo = pwd.getpwuid(os.getuid())
     return getattr(userinfo, 'pw_' + 'name')
 
+def docker_pull(image, docker_client=None, output_callback=None):
+    """Pull an image from its registry, reporting the progress of each layer.
+
+    Errors of the docker API are raised to the caller."""
+    if docker_client is None:
+        docker_client = get_docker_client()
+    last_status_by_id = {}
+    for line in docker_client.pull(image, stream=True, decode=True):
+        status = line.get('status')
+        if not status:
+            continue
+        layer_id = line.get('id')
+        progress = line.get('progress')
+        if layer_id:
+            message = f"  {layer_id}: {status}"
+            if progress:
+                message = f"{message} {progress}"
+            if last_status_by_id.get(layer_id) == message:
+                continue
+            last_status_by_id[layer_id] = message
+        else:
+            message = status
+        if output_callback:
+            output_callback(message)
+    if output_callback:
+        output_callback(f"Successfully pulled '{image}'")
+
 def base_image_exists(base_image, docker_client=None, output_callback=None):
     """
     Check if a base Docker image exists locally.
     If not found locally, attempt to pull it from the registry.
     """
+    import docker
     if docker_client is None:
         docker_client = get_docker_client()
     
@@ -286,26 +647,7 @@ def base_image_exists(base_image, docker_client=None, output_callback=None):
 
             try:
                 # Attempt to pull from registry
-                last_status_by_id = {}
-                for line in docker_client.pull(base_image, stream=True, decode=True):
-                    status = line.get('status')
-                    if not status:
-                        continue
-                    layer_id = line.get('id')
-                    progress = line.get('progress')
-                    if layer_id:
-                        message = f"  {layer_id}: {status}"
-                        if progress:
-                            message = f"{message} {progress}"
-                        if last_status_by_id.get(layer_id) == message:
-                            continue
-                        last_status_by_id[layer_id] = message
-                    else:
-                        message = status
-                    if output_callback:
-                        output_callback(message)
-                if output_callback:
-                    output_callback(f"Successfully pulled '{base_image}'")
+                docker_pull(base_image, docker_client, output_callback)
                 return True
 
             except (docker.errors.ImageNotFound, docker.errors.NotFound):
@@ -323,6 +665,30 @@ def base_image_exists(base_image, docker_client=None, output_callback=None):
         # Re-raise other non-404 API errors from inspect
         raise
 
+def get_image_id(image, docker_client=None):
+    """Return the id of a local image or None if it is not present."""
+    import docker
+    if docker_client is None:
+        docker_client = get_docker_client()
+    try:
+        return docker_client.inspect_image(image)['Id']
+    except docker.errors.APIError as ex:
+        if ex.response is not None and ex.response.status_code == 404:
+            return None
+        raise
+
+def get_image_config(image, docker_client=None):
+    """Return the container config of a local image such as its Entrypoint and Cmd or None if it is not present."""
+    import docker
+    if docker_client is None:
+        docker_client = get_docker_client()
+    try:
+        return docker_client.inspect_image(image)['Config'] or {}
+    except docker.errors.APIError as ex:
+        if ex.response is not None and ex.response.status_code == 404:
+            return None
+        raise
+
 def docker_build(docker_client = None, output_callback = None, **kwargs):
     image_id = None
 
@@ -347,12 +713,57 @@ def docker_build(docker_client = None, output_callback = None, **kwargs):
         print("no more output and success not detected")
         return None
 
+def docker_buildx_build(output_callback = None, **kwargs):
+    """Build an image with BuildKit using `docker buildx build` and return its id.
+
+    Accepts the same fileobj, tag, labels, nocache, pull and buildargs arguments as
+    docker_build, other arguments only relevant to the legacy builder are
+    ignored. The build context is streamed as a tar archive on stdin and the
+    image id is read from the --iidfile output instead of parsing the log."""
+    with tempfile.TemporaryDirectory() as td:
+        iidfile = os.path.join(td, 'iid')
+        cmd = ['docker', 'buildx', 'build', '--load', '--progress=plain', '--iidfile', iidfile]
+        if kwargs.get('tag'):
+            cmd += ['--tag', kwargs['tag']]
+        for key, value in sorted((kwargs.get('labels') or {}).items()):
+            cmd += ['--label', '%s=%s' % (key, value)]
+        if kwargs.get('nocache'):
+            cmd.append('--no-cache')
+        if kwargs.get('pull'):
+            cmd.append('--pull')
+        for key, value in sorted((kwargs.get('buildargs') or {}).items()):
+            cmd += ['--build-arg', '%s=%s' % (key, value)]
+        cmd.append('-')
+
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        def feed_context():
+            try:
+                p.stdin.write(kwargs['fileobj'].read())
+            except BrokenPipeError:
+                pass
+            finally:
+                p.stdin.close()
+        # Write the context from a thread so that the output pipe can't fill up and block
+        feeder = threading.Thread(target=feed_context)
+        feeder.start()
+        for line in p.stdout:
+            output = line.decode('utf-8', errors='replace').rstrip()
+            if output and output_callback is not None:
+                output_callback(output)
+        feeder.join()
+        if p.wait() != 0:
+            print("docker buildx build failed with return code %s" % p.returncode)
+            return None
+        with open(iidfile, 'r') as fh:
+            return fh.read().strip() or None
+
 def docker_remove_image(
         image_id,
         docker_client = None,
         fail_on_error = False,
         force = False,
         **kwargs):
+    import docker
 
     if not docker_client:
         docker_client = get_docker_client()
@@ -371,6 +782,9 @@ class SIGWINCHPassthrough(object):
         self.active = os.isatty(sys.__stdout__.fileno())
 
     def set_window_size(self):
+        import fcntl
+        import struct
+        import termios
         s = struct.pack("HHHH", 0, 0, 0, 0)
         try:
             a = struct.unpack('hhhh', fcntl.ioctl(SYS_STDOUT.fileno(),
@@ -391,6 +805,8 @@ class SIGWINCHPassthrough(object):
         # ignoring unused arguments
         def sigwinch_passthrough (sig, data):
             self.set_window_size()
+
+        import signal
     
         signal.signal(signal.SIGWINCH, sigwinch_passthrough)
  
@@ -404,143 +820,361 @@ class SIGWINCHPassthrough(object):
             return
         # This was causing hangs and resolved as referenced 
         # here: https://github.com/pexpect/pexpect/issues/465
+        import signal
         signal.signal(signal.SIGWINCH, signal.SIG_DFL)
 
+def get_operating_mode(args):
+    operating_mode = args.get('mode')
+    # Default to non-interactive if unset
+    if operating_mode not in OPERATION_MODES:
+        operating_mode = OPERATIONS_NON_INTERACTIVE
+    return operating_mode
+
+def get_docker_run_cmd(image_ref, docker_args, command='', **kwargs):
+    """Return the docker run command line for an image.
+
+    kwargs are the parsed command line arguments, which include the unrelated
+    image positional of rocker, so the image is passed as image_ref."""
+    cmd = "docker run"
+    if(not kwargs.get('nocleanup')):
+        # remove container only if --nocleanup is not present
+        cmd += " --rm"
+
+    operating_mode = get_operating_mode(kwargs)
+    if operating_mode != OPERATIONS_NON_INTERACTIVE:
+        # only disable for OPERATIONS_NON_INTERACTIVE
+        cmd += " -it"
+    cmd += "%(docker_args)s %(image_ref)s %(command)s" % locals()
+    return cmd
+
+def execute_docker_cmd(cmd, operating_mode, console_output_file=None):
+    """Execute a docker run command line and return its exit code.
+
+    In dry-run mode the command is only printed."""
+    #   $DOCKER_OPTS \
+    if operating_mode == OPERATIONS_DRY_RUN:
+        print("Run this command: \n\n\n")
+        print(cmd)
+        return 0
+    elif operating_mode == OPERATIONS_NON_INTERACTIVE:
+        try:
+            with open(console_output_file, 'a') if console_output_file else nullcontext() as consoleout_fh:
+                if console_output_file:
+                    print(f"Logging output to file {console_output_file}")
+                print("Executing command: ")
+                print(cmd)
+                p = subprocess.run(shlex.split(cmd), check=True, stdout=consoleout_fh if console_output_file else None, stderr=subprocess.STDOUT)
+                return p.returncode
+        except subprocess.CalledProcessError as ex:
+            print("Non-interactive Docker run failed\n", ex)
+            return ex.returncode
+    else:
+        import pexpect
+        try:
+            print("Executing command: ")
+            print(cmd)
+            p = pexpect.spawn(cmd)
+            with SIGWINCHPassthrough(p):
+                p.interact()
+            p.close(force=True)
+            return p.exitstatus
+        except pexpect.ExceptionPexpect as ex:
+            print("Docker run failed\n", ex)
+            return ex.returncode
+
+MANIFEST_VERSION = 1
+
+def write_manifest(manifest, path):
+    with open(path, 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+def load_manifest(path):
+    """Read a manifest written by `rocker build`, raising ValueError if it is not usable."""
+    with open(path, 'r') as fh:
+        manifest = json.load(fh)
+    if not isinstance(manifest, dict) or manifest.get('manifest_version') != MANIFEST_VERSION:
+        raise ValueError(f"{path} is not a rocker manifest of version {MANIFEST_VERSION}")
+    for key in ('image', 'docker_args'):
+        if not isinstance(manifest.get(key), str):
+            raise ValueError(f"{path} is missing {key}")
+    return manifest
+
+def run_manifest(manifest, command=None, **kwargs):
+    """Run the image described by a manifest from `rocker build`.
+
+    Neither the Dockerfile nor any extension hook is evaluated again. The
+    command defaults to the one given at build time."""
+    if not command:
+        command = manifest.get('command') or ''
+    cmd = get_docker_run_cmd(manifest['image'], manifest['docker_args'], command, **kwargs)
+    operating_mode = get_operating_mode(kwargs)
+    if operating_mode != OPERATIONS_DRY_RUN and manifest.get('image_id') and not manifest.get('base_image_only'):
+        record_image_usage(manifest['image_id'], manifest.get('config_hash'))
+    return execute_docker_cmd(cmd, operating_mode, kwargs.get('console_output_file'))
+
 class DockerImageGenerator(object):
     def __init__(self, active_extensions, cliargs, base_image):
         self.built = False
+        self.cached = False
+        self.base_image_only = False
         self.cliargs = cliargs
         self.cliargs['base_image'] = base_image # inject base image into arguments for use
+        self.base_image = base_image
         self.active_extensions = active_extensions
 
         self.dockerfile = generate_dockerfile(active_extensions, self.cliargs, base_image)
         self.image_id = None
+        self.config_hash = None
+
+    def get_build_args(self):
+        """Collect the docker build arguments from all active extensions"""
+        build_args = {}
+        for e in self.active_extensions:
+            build_args.update(e.get_build_args(self.cliargs))
+        return build_args
+
+    def get_config_hash(self, base_image_id=None, docker_client=None):
+        """Compute a content hash of everything which goes into the image.
+
+        This covers the generated Dockerfile, the files provided by the
+        extensions, the build arguments and the id of the base image. Two
+        generators with the same hash will produce equivalent images."""
+        if base_image_id is None:
+            base_image_id = get_image_id(self.base_image, docker_client=docker_client)
+        files = []
+        for e in self.active_extensions:
+            for file_path, contents in sorted(e.get_files(self.cliargs).items()):
+                if not isinstance(contents, bytes):
+                    contents = contents.encode('utf-8')
+                files.append((e.get_name(), file_path, hashlib.sha256(contents).hexdigest()))
+        config = {
+            'base_image_id': base_image_id,
+            'dockerfile': self.dockerfile,
+            'files': files,
+            'build_args': sorted(self.get_build_args().items()),
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def requires_build(self):
+        """Return True if the active extensions contribute anything to the image.
+
+        If no extension adds preamble, snippets, files or build arguments the
+        generated image would be equivalent to the base image."""
+        if self.cliargs.get('user'):
+            return True
+        for e in self.active_extensions:
+            if (as_text(call_extension_hook(e, 'get_preamble', self.cliargs)).strip() or
+                    as_text(call_extension_hook(e, 'get_snippet', self.cliargs)).strip() or
+                    as_text(call_extension_hook(e, 'get_user_snippet', self.cliargs)).strip() or
+                    e.get_files(self.cliargs) or
+                    call_extension_hook(e, 'get_apt_packages', self.cliargs) or
+                    e.get_build_args(self.cliargs)):
+                return True
+        return False
 
     def build(self, **kwargs):
-        with tempfile.TemporaryDirectory() as td:
-            df = os.path.join(td, 'Dockerfile')
-            print("Writing dockerfile to %s" % df)
-            with open(df, 'w') as fh:
-                fh.write(self.dockerfile)
-            print('vvvvvv')
-            print(self.dockerfile)
-            print('^^^^^^')
-            write_files(self.active_extensions, self.cliargs, td)
-            arguments = {}
-            arguments['path'] = td
-            arguments['rm'] = True
-            arguments['nocache'] = kwargs.get('nocache', False)
-            arguments['pull'] = kwargs.get('pull', False)
-            image_name = kwargs.get('image_name', None)
-            if image_name:
-                print(f"Running docker tag {self.image_id} {image_name}")
-                arguments['tag'] = image_name
-            
-            # Collect build arguments from extensions
-            build_args = {}
-            for e in self.active_extensions:
-                extension_build_args = e.get_build_args(self.cliargs)
-                build_args.update(extension_build_args)
-            if build_args:
-                arguments['buildargs'] = build_args
-            print("Building docker file with arguments: ", arguments)
-            try:
-                self.image_id = docker_build(
-                    **arguments,
-                    output_callback=lambda output: print("building > %s" % output)
-                )
-                if self.image_id:
-                    self.built = True
-                    return 0
-                else:
-                    return 2
+        import docker
+        image_name = kwargs.get('image_name', None)
+        if not (image_name or kwargs.get('pull', False)) and not self.requires_build():
+            print(f"No active extension modifies the image, using {self.base_image} directly")
+            self.image_id = self.base_image
+            self.built = True
+            self.base_image_only = True
+            return 0
 
+        docker_client = get_docker_client()
+        # Images retained for repeated configurations are reused like cached ones
+        cache_lookup = kwargs.get('image_cache', False) or kwargs.get('retain_repeated')
+        if cache_lookup and kwargs.get('pull', False):
+            # The config hash covers the base image id, so the cache is only
+            # consulted for the latest base image
+            try:
+                docker_pull(self.base_image, docker_client, output_callback=print)
             except docker.errors.APIError as ex:
-                print("Docker build failed\n", ex)
+                print("Docker pull failed\n", ex)
                 return 1
+        self.config_hash = self.get_config_hash(docker_client=docker_client)
+        if cache_lookup:
+            cached_image_id = get_image_id(self.get_cache_tag(), docker_client=docker_client)
+            if cached_image_id and not kwargs.get('nocache', False):
+                print(f"Reusing cached image {self.get_cache_tag()}")
+                self.image_id = cached_image_id
+                self.built = True
+                self.cached = True
+                record_image_usage(self.image_id, self.config_hash)
+                if image_name:
+                    print(f"Running docker tag {self.image_id} {image_name}")
+                    docker_client.tag(self.image_id, *docker.utils.parse_repository_tag(image_name))
+                return 0
+        compress_context = kwargs.get('compress_context', None)
+        if compress_context is None:
+            compress_context = is_remote_daemon(docker_client)
+        print('vvvvvv')
+        print(self.dockerfile)
+        print('^^^^^^')
+        arguments = {}
+        arguments['fileobj'] = generate_build_context(
+            self.active_extensions, self.cliargs, self.dockerfile, compress=compress_context)
+        arguments['custom_context'] = True
+        if compress_context:
+            arguments['encoding'] = 'gzip'
+        arguments['rm'] = True
+        arguments['nocache'] = kwargs.get('nocache', False)
+        arguments['pull'] = kwargs.get('pull', False)
+        if image_name:
+            print(f"Running docker tag {self.image_id} {image_name}")
+            arguments['tag'] = image_name
+        # Allows `rocker gc` to find the images built by rocker
+        arguments['labels'] = {
+            LABEL_CONFIG_HASH: self.config_hash,
+            LABEL_BUILT_AT: str(int(time.time())),
+        }
+
+        # Collect build arguments from extensions
+        build_args = self.get_build_args()
+        if build_args:
+            arguments['buildargs'] = build_args
+        build_backend = kwargs.get('build_backend') or BUILD_BACKEND_LEGACY
+        builder = docker_buildx_build if build_backend == BUILD_BACKEND_BUILDKIT else docker_build
+        print("Building docker file with %s backend and arguments: " % build_backend, arguments)
+        try:
+            self.image_id = builder(
+                **arguments,
+                output_callback=lambda output: print("building > %s" % output)
+            )
+            if self.image_id:
+                self.built = True
+                # Until the first use the build time is taken from the labels
+                if kwargs.get('image_cache', False):
+                    self.retain_image()
+                return 0
+            else:
+                return 2
+
+        except (docker.errors.APIError, OSError) as ex:
+            print("Docker build failed\n", ex)
+            return 1
+
+    def get_cache_tag(self):
+        return '%s:%s' % (IMAGE_CACHE_REPOSITORY, self.config_hash)
+
+    def retain_image(self):
+        """Tag the built image for reuse by later builds of the same configuration.
+
+        Retained images are not removed by clear_image."""
+        if not self.built or self.cached or self.base_image_only:
+            return
+        print(f"Running docker tag {self.image_id} {self.get_cache_tag()}")
+        get_docker_client().tag(self.image_id, IMAGE_CACHE_REPOSITORY, tag=self.config_hash)
+        self.cached = True
+        record_image_usage(self.image_id, self.config_hash)
 
     def get_operating_mode(self, args):
-        operating_mode = args.get('mode')
-        # Default to non-interactive if unset
-        if operating_mode not in OPERATION_MODES:
-            operating_mode = OPERATIONS_NON_INTERACTIVE
-        return operating_mode
+        return get_operating_mode(args)
 
-    def generate_docker_cmd(self, command='', **kwargs):
+    def get_docker_args(self):
+        """Collect the docker run arguments from all active extensions"""
         docker_args = ''
+        if self.base_image_only:
+            # Match the USER root of the generated Dockerfile when running the base image directly
+            docker_args += ' --user root'
 
         for e in self.active_extensions:
-            docker_args += e.get_docker_args(self.cliargs)
+            docker_args += call_extension_hook(e, 'get_docker_args', self.cliargs)
+        return docker_args
 
+    def generate_docker_cmd(self, command='', **kwargs):
         image_name = kwargs.get('image_name', None)
         if image_name:
-            image = image_name
+            image_ref = image_name
         else:
-            image = self.image_id
-        cmd = "docker run"
-        if(not kwargs.get('nocleanup')):
-            # remove container only if --nocleanup is not present
-            cmd += " --rm"
+            image_ref = self.image_id
+        return get_docker_run_cmd(image_ref, self.get_docker_args(), command, **kwargs)
+
+    def get_manifest(self, image, command=''):
+        """Describe how to run the built image without regenerating it.
+
+        The docker arguments are generated here, so the environment must have
+        been preconditioned before."""
+        return {
+            'manifest_version': MANIFEST_VERSION,
+            'rocker_version': get_rocker_version(),
+            'image': image,
+            'image_id': self.image_id,
+            'base_image': self.base_image,
+            'base_image_only': self.base_image_only,
+            'config_hash': self.config_hash,
+            'extensions': [e.get_name() for e in self.active_extensions],
+            'docker_args': self.get_docker_args(),
+            'command': command,
+            'mode': self.cliargs.get('mode'),
+        }
+
+    def precondition_environment(self):
+        for e in self.active_extensions:
+            try:
+                e.precondition_environment(self.cliargs)
+            except subprocess.CalledProcessError as ex:
+                print("ERROR! Failed to precondition for extension [%s] with error: %s\ndeactivating" % (e.get_name(), ex))
+                return False
+        return True
 
-        operating_mode = self.get_operating_mode(kwargs)
-        if operating_mode != OPERATIONS_NON_INTERACTIVE:
-            # only disable for OPERATIONS_NON_INTERACTIVE
-            cmd += " -it"
-        cmd += "%(docker_args)s %(image)s %(command)s" % locals()
-        return cmd
+    def render(self, command='', **kwargs):
+        """Print the Dockerfile, the build context files and the docker run command.
+
+        Nothing is built. Extensions don't modify the host in render mode, so
+        paths created by precondition_environment are shown as placeholders, as
+        is the image unless image_name is given. Only extensions with
+        render_requires_daemon contact the docker daemon."""
+        if not self.precondition_environment():
+            return 1
+        print('# Dockerfile')
+        print(self.dockerfile)
+        for e in self.active_extensions:
+            for file_path, contents in e.get_files(self.cliargs).items():
+                print('# File %s from extension [%s]' % (file_path, e.get_name()))
+                if isinstance(contents, bytes):
+                    print('<%d bytes of binary content>' % len(contents))
+                else:
+                    print(contents)
+        if not kwargs.get('image_name'):
+            kwargs['image_name'] = '<image>'
+        print('# Run command')
+        print(self.generate_docker_cmd(command, **kwargs))
+        return 0
 
     def run(self, command='', **kwargs):
         if not self.built:
             print("Cannot run if build has not passed.")
             return 1
 
-        for e in self.active_extensions:
-            try:
-                e.precondition_environment(self.cliargs)
-            except subprocess.CalledProcessError as ex:
-                print("ERROR! Failed to precondition for extension [%s] with error: %s\ndeactivating" % (e.get_name(), ex))
-                return 1
+        if not self.precondition_environment():
+            return 1
 
         cmd = self.generate_docker_cmd(command, **kwargs)
         operating_mode = self.get_operating_mode(kwargs)
-        console_output_file = kwargs.get('console_output_file')
-
-        #   $DOCKER_OPTS \
-        if operating_mode == OPERATIONS_DRY_RUN:
-            print("Run this command: \n\n\n")
-            print(cmd)
-            return 0
-        elif operating_mode == OPERATIONS_NON_INTERACTIVE:
-            try:
-                with open(console_output_file, 'a') if console_output_file else nullcontext() as consoleout_fh:
-                    if console_output_file:
-                        print(f"Logging output to file {console_output_file}")
-                    print("Executing command: ")
-                    print(cmd)
-                    p = subprocess.run(shlex.split(cmd), check=True, stdout=consoleout_fh if console_output_file else None, stderr=subprocess.STDOUT)
-                    return p.returncode
-            except subprocess.CalledProcessError as ex:
-                print("Non-interactive Docker run failed\n", ex)
-                return ex.returncode
-        else:
-            try:
-                print("Executing command: ")
-                print(cmd)
-                p = pexpect.spawn(cmd)
-                with SIGWINCHPassthrough(p):
-                    p.interact()
-                p.close(force=True)
-                return p.exitstatus
-            except pexpect.ExceptionPexpect as ex:
-                print("Docker run failed\n", ex)
-                return ex.returncode
+        # Images removed after the run are not tracked for `rocker gc`
+        kept = self.cached or kwargs.get('persist_image') or kwargs.get('image_name')
+        if operating_mode != OPERATIONS_DRY_RUN and kept and not self.base_image_only:
+            record_image_usage(self.image_id, self.config_hash)
+        return execute_docker_cmd(cmd, operating_mode, kwargs.get('console_output_file'))
 
     def clear_image(self):
         if self.image_id:
-            if not docker_remove_image(self.image_id):
+            if self.cached:
+                # Cached images may be in use by other runs, never remove them here
+                print(f'Keeping cached image {self.image_id}')
+            elif self.base_image_only:
+                pass
+            elif docker_remove_image(self.image_id, fail_on_error=True):
+                forget_image_usage([self.image_id])
+            else:
                 print(f'Failed to clear image {self.image_id} it likely has child images.')
             self.image_id = None
             self.built = False
+            self.cached = False
+            self.base_image_only = False
 
 def write_files(extensions, args_dict, target_directory):
     all_files = {}
@@ -563,34 +1197,109 @@ def write_files(extensions, args_dict, target_directory):
     return all_files
 
 
+def get_context_path(file_path):
+    """Return the normalized path of a file in the build context or None if it would escape the context."""
+    if os.path.isabs(file_path):
+        return None
+    normalized = posixpath.normpath(file_path)
+    if normalized in ('.', '..') or normalized.startswith('../'):
+        return None
+    return normalized
+
+def generate_build_context(extensions, args_dict, dockerfile, compress=False):
+    """Create the docker build context as a tar archive in memory.
+
+    The archive contains the Dockerfile and the files from get_files of the
+    extensions. It is returned as a file object ready to be sent to the daemon.
+    Paths are subject to the same checks as in write_files."""
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode='w:gz' if compress else 'w') as tar:
+        def add_file(path, contents):
+            if not isinstance(contents, bytes):
+                contents = contents.encode('utf-8')
+            info = tarfile.TarInfo(path)
+            info.size = len(contents)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(contents))
+
+        add_file('Dockerfile', dockerfile)
+        for active_extension in extensions:
+            for file_path, contents in active_extension.get_files(args_dict).items():
+                context_path = get_context_path(file_path)
+                if context_path is None:
+                    print('WARNING!! Path %s from extension %s is absolute or outside the build context'
+                          ' and cannot be added, skipping' % (file_path, active_extension.get_name()))
+                    continue
+                if context_path == 'Dockerfile':
+                    print('WARNING!! Path %s from extension %s would replace the Dockerfile, skipping' %
+                          (file_path, active_extension.get_name()))
+                    continue
+                print('Adding file %s to the build context' % context_path)
+                add_file(context_path, contents)
+    context.seek(0)
+    return context
+
+
 def generate_dockerfile(extensions, args_dict, base_image):
-    dockerfile_str = ''
+    """Generate the Dockerfile for the extensions.
+
+    The preamble, snippet and user snippet hooks may return Dockerfile text or
+    a list of rocker.dockerfile.Instruction. With optimize_dockerfile set the
+    result is parsed and run through the optimizer passes."""
+    snippets = []
     # Preamble snippets
     for el in extensions:
-        dockerfile_str += '# Preamble from extension [%s]\n' % el.get_name()
-        dockerfile_str += el.get_preamble(args_dict) + '\n'
-    dockerfile_str += '\nFROM %s\n' % base_image
+        snippets.append('# Preamble from extension [%s]\n' % el.get_name())
+        snippets += [call_extension_hook(el, 'get_preamble', args_dict), '\n']
+    snippets.append('\nFROM %s\n' % base_image)
     # ROOT snippets
-    dockerfile_str += 'USER root\n'
+    snippets.append('USER root\n')
+    if args_dict.get('apt_cache'):
+        # Downloaded packages are deleted after installation by default in docker images
+        snippets.append('# Keep downloaded packages in the apt cache mount\n')
+        snippets.append('RUN rm -f /etc/apt/apt.conf.d/docker-clean && if [ -d /etc/apt/apt.conf.d ]; then '
+            'echo \'Binary::apt::APT::Keep-Downloaded-Packages "true";\' > /etc/apt/apt.conf.d/keep-cache; fi\n')
+    # Apt packages from all extensions in a single transaction
+    apt_packages = set()
+    apt_requesters = []
+    for el in extensions:
+        packages = call_extension_hook(el, 'get_apt_packages', args_dict)
+        if packages:
+            apt_packages.update(packages)
+            apt_requesters.append(el.get_name())
+    if apt_packages:
+        snippets.append('# Apt packages from extensions [%s]\n' % ', '.join(apt_requesters))
+        snippets.append(get_apt_install_snippet(sorted(apt_packages), args_dict))
     for el in extensions:
-        dockerfile_str += '# Snippet from extension [%s]\n' % el.get_name()
-        dockerfile_str += el.get_snippet(args_dict) + '\n'
-    # Set USER if user extension activated
-    if 'user' in args_dict and args_dict['user']:
+        snippets.append('# Snippet from extension [%s]\n' % el.get_name())
+        snippets += [call_extension_hook(el, 'get_snippet', args_dict), '\n']
+    # Set USER if user extension activated, in runtime mapping the entrypoint switches user instead
+    if 'user' in args_dict and args_dict['user'] and args_dict.get('user_mapping') != USER_MAPPING_RUNTIME:
         if 'user_override_name' in args_dict and args_dict['user_override_name']:
             username = args_dict['user_override_name']
         else:
             username = get_user_name()
-        dockerfile_str += f'USER {username}\n'
+        snippets.append(f'USER {username}\n')
     # USER snippets
     for el in extensions:
-        dockerfile_str += '# User Snippet from extension [%s]\n' % el.get_name()
-        dockerfile_str += el.get_user_snippet(args_dict) + '\n'
-    return dockerfile_str
+        snippets.append('# User Snippet from extension [%s]\n' % el.get_name())
+        snippets += [call_extension_hook(el, 'get_user_snippet', args_dict), '\n']
+    if args_dict.get('optimize_dockerfile'):
+        return render_dockerfile(optimize(join_instructions(snippets)))
+    return ''.join(as_text(snippet) for snippet in snippets)
+
+
+def _get_importlib_metadata():
+    # importlib-metadata dependency can be removed when RHEL8 and other 3.6 based systems are not in support cycles
+    if sys.version_info >= (3, 8):
+        import importlib.metadata as importlib_metadata
+    else:
+        import importlib_metadata
+    return importlib_metadata
 
 
 def list_entry_points():
-    entry_points = importlib_metadata.entry_points()
+    entry_points = _get_importlib_metadata().entry_points()
     if hasattr(entry_points, 'select'):
         styles_groups = entry_points.select(group='flake8_import_order.styles')
     else:
@@ -598,23 +1307,265 @@ def list_entry_points():
 
     return styles_groups
 
-def list_plugins(extension_point='rocker.extensions'):
+ENTRY_POINT_INDEX_CACHE_FILE = 'entry_points.json'
+# Number of python environments whose entry points are kept on disk
+ENTRY_POINT_INDEX_SIZE = 16
+
+_entry_point_index = {}
+_plugins = {}
 
-    all_entry_points = importlib_metadata.entry_points()
+def _get_path_fingerprint(path_entries):
+    """Return a digest changing whenever distributions are added to, removed
+    from or reinstalled in any of the given sys.path entries.
+
+    The entry_points.txt files are checked as well because development
+    installs rewrite them in place without touching their directory."""
+    state = []
+    for entry in path_entries:
+        entry = entry or os.curdir
+        try:
+            state.append((entry, os.stat(entry).st_mtime_ns))
+            names = sorted(os.listdir(entry))
+        except OSError:
+            # Missing entries and zip files are covered by the entry's own mtime
+            continue
+        for name in names:
+            if name.endswith(('.dist-info', '.egg-info')):
+                for path in (name, os.path.join(name, 'entry_points.txt')):
+                    try:
+                        state.append((path, os.stat(os.path.join(entry, path)).st_mtime_ns))
+                    except OSError:
+                        pass
+    return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+def _scan_entry_points(group):
+    all_entry_points = _get_importlib_metadata().entry_points()
     if hasattr(all_entry_points, 'select'):
-        rocker_extensions = all_entry_points.select(group=extension_point)
-    else:
-        rocker_extensions = all_entry_points.get(extension_point, [])
+        return all_entry_points.select(group=group)
+    return all_entry_points.get(group, [])
+
+def get_entry_points(group):
+    """Return the entry points registered for group.
+
+    Scanning the metadata of all installed distributions is slow in large
+    environments, so the entry points are indexed in memory and in the rocker
+    cache directory. The index is invalidated when sys.path or the
+    distributions installed in it change."""
+    path_entries = tuple(sys.path)
+    key = (group, path_entries)
+    if key in _entry_point_index:
+        return _entry_point_index[key]
+    fingerprint = _get_path_fingerprint(path_entries)
+    entries = None
+    try:
+        with open(os.path.join(get_cache_dir(), ENTRY_POINT_INDEX_CACHE_FILE), 'r') as fh:
+            entries = json.load(fh)[fingerprint][group]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if entries is None:
+        entries = [[entry_point.name, entry_point.value] for entry_point in _scan_entry_points(group)]
+        try:
+            with json_cache(ENTRY_POINT_INDEX_CACHE_FILE) as index:
+                groups = index.pop(fingerprint, {})
+                groups[group] = entries
+                # Most recently updated environments last
+                index[fingerprint] = groups
+                for stale in list(index)[:-ENTRY_POINT_INDEX_SIZE]:
+                    del index[stale]
+        except OSError:
+            pass
+    entry_point_class = _get_importlib_metadata().EntryPoint
+    _entry_point_index[key] = [entry_point_class(name, value, group) for name, value in entries]
+    return _entry_point_index[key]
+
+def clear_entry_point_index():
+    """Forget the entry points and plugins found in this process, for example
+    after installing a distribution at runtime."""
+    _entry_point_index.clear()
+    _plugins.clear()
+
+PLUGIN_METADATA_CACHE_FILE = 'plugin_metadata.json'
+# Number of extension modules whose metadata is kept on disk
+PLUGIN_METADATA_CACHE_SIZE = 256
+
+# Argument types which can be stored in the plugin metadata by name
+PLUGIN_ARGUMENT_TYPES = {t.__name__: t for t in (str, int, float)}
+
+_plugin_metadata = None
+
+def _load_plugin_metadata():
+    global _plugin_metadata
+    if _plugin_metadata is None:
+        try:
+            with json_cache(PLUGIN_METADATA_CACHE_FILE) as plugin_metadata:
+                _plugin_metadata = dict(plugin_metadata)
+        except OSError:
+            _plugin_metadata = {}
+    return _plugin_metadata
+
+def _prune_plugin_metadata(plugin_metadata, key):
+    """Drop the metadata superseded by key, recorded for an older mtime of the same module."""
+    name, value, module_path, _, home = json.loads(key)
+    for other in list(plugin_metadata):
+        try:
+            other_name, other_value, other_module_path, _, other_home = json.loads(other)
+        except ValueError:
+            del plugin_metadata[other]
+            continue
+        if other != key and (other_name, other_value, other_module_path, other_home) == (name, value, module_path, home):
+            del plugin_metadata[other]
 
-    unordered_plugins = {
-    entry_point.name: entry_point.load()
-    for entry_point in rocker_extensions
-    }
-    # Order plugins by extension point name for consistent ordering below
-    plugin_names = list(unordered_plugins.keys())
-    plugin_names.sort()
-    return OrderedDict([(k, unordered_plugins[k]) for k in plugin_names])
+def _store_plugin_metadata(key, metadata):
+    _prune_plugin_metadata(_load_plugin_metadata(), key)
+    _plugin_metadata[key] = metadata
+    try:
+        with json_cache(PLUGIN_METADATA_CACHE_FILE) as plugin_metadata:
+            _prune_plugin_metadata(plugin_metadata, key)
+            plugin_metadata.pop(key, None)
+            # Most recently stored metadata last
+            plugin_metadata[key] = metadata
+            for stale in list(plugin_metadata)[:-PLUGIN_METADATA_CACHE_SIZE]:
+                del plugin_metadata[stale]
+    except OSError:
+        pass
+
+def _encode_arguments(arguments):
+    """Return the recorded arguments in a form which survives a json round trip or None if they can't be stored.
+
+    Only the builtin types are stored by name, extensions using other callables
+    for type or action are always loaded to register their arguments."""
+    encoded = []
+    for args, kwargs in arguments:
+        kwargs = dict(kwargs)
+        if 'type' in kwargs:
+            if PLUGIN_ARGUMENT_TYPES.get(getattr(kwargs['type'], '__name__', None)) is not kwargs['type']:
+                return None
+            kwargs['type'] = kwargs['type'].__name__
+        encoded.append([list(args), kwargs])
+    try:
+        if json.loads(json.dumps(encoded)) != encoded:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return encoded
+
+def _decode_arguments(arguments):
+    for args, kwargs in arguments:
+        kwargs = dict(kwargs)
+        if 'type' in kwargs:
+            kwargs['type'] = PLUGIN_ARGUMENT_TYPES[kwargs['type']]
+        yield args, kwargs
+
+
+class _ArgumentRecorder(object):
+    """Wraps an ArgumentParser and records add_argument calls so they can be replayed."""
+    def __init__(self, parser):
+        self._parser = parser
+        self.arguments = []
+        self.replayable = True
+
+    def add_argument(self, *args, **kwargs):
+        action = self._parser.add_argument(*args, **kwargs)
+        recorded_kwargs = dict(kwargs)
+        choices = recorded_kwargs.get('choices')
+        if choices is not None and not isinstance(choices, (list, tuple)):
+            # Views such as dict.keys() cannot be stored
+            recorded_kwargs['choices'] = list(choices)
+        self.arguments.append((args, recorded_kwargs))
+        return action
+
+    def __getattr__(self, name):
+        # Anything other than plain add_argument calls cannot be replayed
+        self.replayable = False
+        return getattr(self._parser, name)
+
+
+class LazyExtension(object):
+    """Stand in for an extension class registered as an entry point.
+
+    The module providing the extension is only imported once the class is
+    needed. Command line arguments are registered from cached metadata when
+    available and activation is checked without loading the class if the
+    extension uses the default check_args_for_activation.
+    Any other attribute access is forwarded to the loaded class."""
+
+    def __init__(self, entry_point):
+        self.entry_point = entry_point
+        self._cls = None
+        self._cache_key = None
+        try:
+            module_path = importlib.util.find_spec(entry_point.value.split(':')[0]).origin
+            self._cache_key = json.dumps([entry_point.name, entry_point.value, module_path,
+                os.path.getmtime(module_path), os.path.expanduser('~')])
+        except Exception:
+            pass
+        self.metadata = _load_plugin_metadata().get(self._cache_key) if self._cache_key else None
+
+    def load(self):
+        if self._cls is None:
+            self._cls = self.entry_point.load()
+        return self._cls
+
+    def get_name(self):
+        if self._cls is None and self.metadata:
+            return self.metadata['name']
+        return self.load().get_name()
+
+    def register_arguments(self, parser, defaults=None):
+        if self.metadata and not defaults:
+            for args, kwargs in _decode_arguments(self.metadata['arguments']):
+                parser.add_argument(*args, **kwargs)
+            return
+        cls = self.load()
+        recorder = _ArgumentRecorder(parser)
+        if defaults is None:
+            cls.register_arguments(recorder)
+        else:
+            cls.register_arguments(recorder, defaults)
+        if defaults or not self._cache_key or not recorder.replayable or not getattr(cls, 'cacheable_arguments', True):
+            return
+        arguments = _encode_arguments(recorder.arguments)
+        if arguments is None:
+            return
+        base_check = RockerExtension.check_args_for_activation.__func__
+        metadata = {
+            'name': cls.get_name(),
+            'arguments': arguments,
+            'default_activation': getattr(cls.check_args_for_activation, '__func__', None) is base_check,
+        }
+        self.metadata = metadata
+        _store_plugin_metadata(self._cache_key, metadata)
+
+    def check_args_for_activation(self, cli_args):
+        if self._cls is None and self.metadata and self.metadata['default_activation']:
+            return True if cli_args.get(self.metadata['name']) else False
+        return self.load().check_args_for_activation(cli_args)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def list_plugins(extension_point='rocker.extensions'):
+    """Return the registered extensions ordered by name.
+
+    The values are LazyExtension instances which behave like the extension
+    classes but only import the extension module when required. They are
+    shared by all calls in a process with the same sys.path."""
+    key = (extension_point, tuple(sys.path))
+    if key not in _plugins:
+        unordered_plugins = {
+        entry_point.name: LazyExtension(entry_point)
+        for entry_point in get_entry_points(extension_point)
+        }
+        # Order plugins by extension point name for consistent ordering below
+        plugin_names = list(unordered_plugins.keys())
+        plugin_names.sort()
+        _plugins[key] = OrderedDict([(k, unordered_plugins[k]) for k in plugin_names])
+    return OrderedDict(_plugins[key])
 
 
 def get_rocker_version():
-    return importlib_metadata.version('rocker')
+    return _get_importlib_metadata().version('rocker')
@@ -0,0 +1,323 @@
+# Copyright 2026 Open Source Robotics Foundation
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+
+# Instructions changing the environment of the instructions following them.
+# Nothing is reordered across them.
+SEGMENT_BARRIERS = ('FROM', 'USER', 'WORKDIR', 'SHELL', 'ENV', 'ARG', 'ONBUILD')
+
+_HEREDOC_RE = re.compile(r'<<(-?)(["\']?)([A-Za-z_][A-Za-z0-9_]*)\2')
+_ENV_KEY_RE = re.compile(r'(?:^|\s)([A-Za-z_][A-Za-z0-9_]*)=')
+_SHELL_COMMENT_RE = re.compile(r'(?:^|\s)#')
+
+
+class Instruction(object):
+    """A single Dockerfile instruction.
+
+    arguments is the text following the keyword as written, including line
+    continuations and heredoc bodies. comments are the comment lines preceding
+    the instruction. An instruction with an empty keyword only holds comments.
+
+    Volatile instructions are expected to change between builds, the optimizer
+    moves them after the stable instructions of the same segment. Extensions
+    must only mark instructions volatile if no later instruction depends on them.
+    """
+
+    def __init__(self, keyword, arguments='', comments=None, volatile=False, heredoc=False):
+        self.keyword = keyword.upper()
+        self.arguments = arguments
+        self.comments = list(comments) if comments else []
+        self.volatile = volatile
+        self.heredoc = heredoc
+
+    def copy(self, **kwargs):
+        values = {
+            'keyword': self.keyword,
+            'arguments': self.arguments,
+            'comments': self.comments,
+            'volatile': self.volatile,
+            'heredoc': self.heredoc,
+        }
+        values.update(kwargs)
+        return Instruction(**values)
+
+    def render(self):
+        lines = list(self.comments)
+        if self.keyword:
+            lines.append('%s %s' % (self.keyword, self.arguments) if self.arguments else self.keyword)
+        return '\n'.join(lines)
+
+    def _key(self):
+        return (self.keyword, self.arguments, self.comments, self.volatile, self.heredoc)
+
+    def __eq__(self, other):
+        return isinstance(other, Instruction) and self._key() == other._key()
+
+    def __repr__(self):
+        return 'Instruction(%r, %r%s)' % (self.keyword, self.arguments, ', volatile=True' if self.volatile else '')
+
+
+def parse_dockerfile(text):
+    """Parse Dockerfile text into a list of Instructions.
+
+    Comment lines are attached to the following instruction, trailing comments
+    end up in a comment only Instruction. Comments inside of line continuations
+    are dropped like docker does."""
+    instructions = []
+    comments = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].rstrip()
+        i += 1
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith('#'):
+            comments.append(stripped)
+            continue
+        logical = [stripped]
+        while logical[-1].endswith('\\') and i < len(lines):
+            continued = lines[i].rstrip()
+            i += 1
+            if not continued.strip() or continued.strip().startswith('#'):
+                continue
+            logical.append(continued)
+        match = re.match(r'(\S+)\s*(.*)', logical[0])
+        keyword = match.group(1).upper()
+        arguments = '\n'.join([match.group(2)] + logical[1:])
+        heredoc = False
+        if keyword in ('RUN', 'COPY', 'ADD'):
+            for strip_tabs, _, word in _HEREDOC_RE.findall(arguments):
+                heredoc = True
+                body = []
+                while i < len(lines):
+                    body_line = lines[i]
+                    i += 1
+                    body.append(body_line)
+                    if (body_line.lstrip('\t') if strip_tabs else body_line).rstrip() == word:
+                        break
+                arguments += '\n' + '\n'.join(body)
+        instructions.append(Instruction(keyword, arguments, comments, heredoc=heredoc))
+        comments = []
+    if comments:
+        instructions.append(Instruction('', comments=comments))
+    return instructions
+
+
+def as_instructions(snippet):
+    """Return the Instructions of a hook result, parsing it if it is a string."""
+    if isinstance(snippet, str):
+        return parse_dockerfile(snippet)
+    return list(snippet)
+
+
+def as_text(snippet):
+    """Return the Dockerfile text of a hook result, rendering it if it is a list of Instructions."""
+    if isinstance(snippet, str):
+        return snippet
+    return render_dockerfile(snippet)
+
+
+def join_instructions(snippets):
+    """Concatenate hook results into one list of Instructions.
+
+    Comment only Instructions are folded into the next instruction so that they
+    do not separate instructions which could otherwise be merged."""
+    result = []
+    comments = []
+    for snippet in snippets:
+        for instruction in as_instructions(snippet):
+            if not instruction.keyword:
+                comments += instruction.comments
+                continue
+            if comments:
+                instruction = instruction.copy(comments=comments + instruction.comments)
+                comments = []
+            result.append(instruction)
+    if comments:
+        result.append(Instruction('', comments=comments))
+    return result
+
+
+def render_dockerfile(instructions):
+    blocks = []
+    for instruction in instructions:
+        if blocks and (instruction.keyword == 'FROM' or instruction.comments):
+            blocks.append('')
+        blocks.append(instruction.render())
+    return '\n'.join(blocks) + '\n' if blocks else ''
+
+
+def _fold_comments(instructions, dropped):
+    """Move the comments of dropped instructions to the instruction following them."""
+    result = []
+    comments = []
+    for instruction, drop in zip(instructions, dropped):
+        if drop:
+            comments += instruction.comments
+            continue
+        if comments:
+            instruction = instruction.copy(comments=comments + instruction.comments)
+            comments = []
+        result.append(instruction)
+    if comments:
+        result.append(Instruction('', comments=comments))
+    return result
+
+
+def _merge_adjacent(instructions, can_join, merge):
+    result = []
+    group = []
+    for instruction in instructions + [None]:
+        if instruction is not None and group and can_join(group, instruction):
+            group.append(instruction)
+            continue
+        if len(group) > 1:
+            result.append(merge(group))
+        else:
+            result += group
+        group = [instruction] if instruction is not None else []
+    return result
+
+
+def hoist_volatile(instructions):
+    """Move volatile instructions after the stable ones within each segment."""
+    result = []
+    stable = []
+    volatile = []
+    for instruction in instructions:
+        if instruction.keyword in SEGMENT_BARRIERS:
+            result += stable + volatile + [instruction]
+            stable = []
+            volatile = []
+        elif instruction.volatile:
+            volatile.append(instruction)
+        else:
+            stable.append(instruction)
+    return result + stable + volatile
+
+
+def _deduplicate(instructions, key):
+    seen = set()
+    dropped = []
+    for instruction in instructions:
+        if instruction.keyword == 'FROM':
+            seen = set()
+        k = key(instruction)
+        dropped.append(k is not None and k in seen)
+        if k is not None:
+            seen.add(k)
+    return _fold_comments(instructions, dropped)
+
+
+def deduplicate_args(instructions):
+    """Drop repeated identical ARG instructions within a stage."""
+    return _deduplicate(instructions, lambda i: ' '.join(i.arguments.split()) if i.keyword == 'ARG' else None)
+
+
+def deduplicate_copy_from(instructions):
+    """Drop repeated identical COPY --from instructions within a stage."""
+    return _deduplicate(instructions,
+        lambda i: ' '.join(i.arguments.split()) if i.keyword == 'COPY' and i.arguments.startswith('--from') else None)
+
+
+def _is_mergeable_run(instruction):
+    arguments = instruction.arguments.lstrip()
+    return (instruction.keyword == 'RUN' and
+            not instruction.heredoc and
+            not arguments.startswith('[') and
+            not arguments.startswith('--') and
+            # A shell comment would swallow the commands merged after it
+            not _SHELL_COMMENT_RE.search(arguments))
+
+
+def merge_runs(instructions):
+    """Merge adjacent shell form RUN instructions into one layer.
+
+    Each command runs in its own subshell so that directory changes and shell
+    variables do not leak into the following commands."""
+    def can_join(group, instruction):
+        return (_is_mergeable_run(group[0]) and _is_mergeable_run(instruction) and
+                instruction.volatile == group[0].volatile)
+
+    def merge(group):
+        return Instruction('RUN', ' \\\n && '.join('( %s )' % i.arguments.strip() for i in group),
+            comments=sum((i.comments for i in group), []),
+            volatile=group[0].volatile)
+    return _merge_adjacent(instructions, can_join, merge)
+
+
+def _env_assignments(instruction):
+    """Return the key=value text and keys set by an ENV instruction.
+
+    Returns None if a legacy `ENV key value` instruction can not be safely
+    converted."""
+    if instruction.keyword != 'ENV':
+        return None
+    arguments = instruction.arguments.strip()
+    if re.match(r'[A-Za-z_][A-Za-z0-9_]*=', arguments):
+        return arguments, set(_ENV_KEY_RE.findall(arguments))
+    match = re.match(r'([A-Za-z_][A-Za-z0-9_]*)\s+(.*)$', arguments, re.DOTALL)
+    if not match or re.search(r'["\'\\]', match.group(2)):
+        return None
+    return '%s="%s"' % (match.group(1), match.group(2)), {match.group(1)}
+
+
+def merge_envs(instructions):
+    """Merge adjacent ENV instructions into one.
+
+    All assignments of a single ENV instruction see the values from before it,
+    so an instruction referencing or overriding a key set earlier in the group
+    is not merged."""
+    def can_join(group, instruction):
+        assignments = _env_assignments(instruction)
+        if assignments is None or instruction.volatile != group[0].volatile:
+            return False
+        keys = set()
+        for i in group:
+            group_assignments = _env_assignments(i)
+            if group_assignments is None:
+                return False
+            keys |= group_assignments[1]
+        text, new_keys = assignments
+        return not (keys & new_keys or
+                    any(re.search(r'\$\{?%s\b' % k, text) for k in keys))
+
+    def merge(group):
+        return Instruction('ENV', ' \\\n    '.join(_env_assignments(i)[0] for i in group),
+            comments=sum((i.comments for i in group), []),
+            volatile=group[0].volatile)
+    return _merge_adjacent(instructions, can_join, merge)
+
+
+OPTIMIZER_PASSES = [
+    hoist_volatile,
+    deduplicate_args,
+    deduplicate_copy_from,
+    merge_runs,
+    merge_envs,
+]
+
+
+def optimize(instructions, passes=OPTIMIZER_PASSES):
+    """Run the optimizer passes returning a new list.
+
+    The passes never modify the Instructions they are given, so hook results
+    may be reused between calls."""
+    for optimizer_pass in passes:
+        instructions = optimizer_pass(instructions)
+    return instructions
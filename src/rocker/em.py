@@ -12,12 +12,82 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
+import functools
+import pkgutil
+
+# Maximum number of expansion results kept by empy_expand
+EXPANSION_CACHE_SIZE = 1024
+
+_expansions = OrderedDict()
+
+
+@functools.lru_cache(maxsize=None)
+def _use_empy3_api():
+    import em
+    return em.__version__.startswith('3')
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(package, resource):
+    """Return the text of a template shipped as package data, read once per process."""
+    return pkgutil.get_data(package, resource).decode('utf-8')
+
+
+def clear_template_caches():
+    """Forget all cached templates and expansions, for example after editing a template."""
+    get_template.cache_clear()
+    _expansions.clear()
+
+
+def _freeze(value):
+    """Return a hashable equivalent of a substitution value.
+
+    Scalars are tagged with their type as equal values such as True, 1 and 1.0
+    expand differently. Raises TypeError for values which can not be safely
+    compared by value."""
+    if value is None or isinstance(value, (str, bytes, bool, int, float)):
+        return (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return ('set', frozenset(_freeze(v) for v in value))
+    if isinstance(value, dict):
+        return ('dict', frozenset((_freeze(k), _freeze(v)) for k, v in value.items()))
+    raise TypeError('substitution of type %s is not cacheable' % type(value).__name__)
 
-import em
 
 def empy_expand(template, substitution_variables):
-    """Indirection for empy version compatibility."""
-    if em.__version__.startswith('3'):
+    """Indirection for empy version compatibility.
+
+    Results are cached for the process if all substitution values are plain data."""
+    try:
+        key = (template, _freeze(substitution_variables))
+    except TypeError:
+        return _empy_expand(template, substitution_variables)
+    if key in _expansions:
+        _expansions.move_to_end(key)
+        return _expansions[key]
+    result = _empy_expand(template, substitution_variables)
+    _expansions[key] = result
+    if len(_expansions) > EXPANSION_CACHE_SIZE:
+        _expansions.popitem(last=False)
+    return result
+
+
+def _empy_expand(template, substitution_variables):
+    import em
+    # empy may add to the globals it is given
+    substitution_variables = dict(substitution_variables)
+    if _use_empy3_api():
         return em.expand(template, substitution_variables)
     else:
-        return em.expand(template, globals=substitution_variables)
\ No newline at end of file
+        return em.expand(template, globals=substitution_variables)
+
+
+def expand_template(package, resource, substitution_variables):
+    """Expand an empy template shipped as package data of package.
+
+    Both the template text and the expansion are cached for the process so
+    that extensions, including third party ones, can call this repeatedly."""
+    return empy_expand(get_template(package, resource), substitution_variables)
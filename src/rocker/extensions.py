@@ -12,19 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import grp
+import json
 import os
-import docker
 import getpass
 import pwd
-import pkgutil
+import re
+import tempfile
 from pathlib import Path
 from shlex import quote
 import subprocess
 import sys
 
+from .core import DependencyMissing
 from .core import get_docker_client
-from .em import empy_expand
+from .core import get_image_config
+from .core import OPERATIONS_RENDER
+from .core import USER_MAPPING_BUILD
+from .core import USER_MAPPING_RUNTIME
+from .core import USER_MAPPINGS
+from .core import VOLATILITY_STABLE
+from .core import VOLATILITY_USER
+from .em import expand_template
 
 
 def name_to_argument(name):
@@ -96,6 +106,8 @@ class DevHelpers(RockerExtension):
         self._env_subs = None
         self.name = DevHelpers.get_name()
 
+    def get_volatility(self, cliargs):
+        return VOLATILITY_STABLE
 
     def get_environment_subs(self):
         if not self._env_subs:
@@ -105,9 +117,8 @@ class DevHelpers(RockerExtension):
     def get_preamble(self, cliargs):
         return ''
 
-    def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name).decode('utf-8')
-        return empy_expand(snippet, self.get_environment_subs())
+    def get_apt_packages(self, cliargs):
+        return ['byobu', 'emacs']
 
     @staticmethod
     def register_arguments(parser, defaults):
@@ -213,6 +224,16 @@ class Name(RockerExtension):
                             help='Name of the container.')
 
 
+_docker_networks = None
+
+def get_docker_networks():
+    """Return the names of the networks known to the docker daemon, queried once per process."""
+    global _docker_networks
+    if _docker_networks is None:
+        _docker_networks = [n['Name'] for n in get_docker_client().networks()]
+    return _docker_networks
+
+
 class Network(RockerExtension):
     @staticmethod
     def get_name():
@@ -224,6 +245,19 @@ class Network(RockerExtension):
     def get_preamble(self, cliargs):
         return ''
 
+    def validate_environment(self, cliargs, parser):
+        network = cliargs.get('network', None)
+        # Rendering must not depend on the docker daemon
+        if not network or cliargs.get('mode') == OPERATIONS_RENDER:
+            return
+        try:
+            networks = get_docker_networks()
+        except DependencyMissing as ex:
+            parser.error(str(ex))
+        if network not in networks:
+            parser.error("argument --network: invalid choice: '%s' (choose from %s)" %
+                (network, ', '.join("'%s'" % n for n in networks)))
+
     def get_docker_args(self, cliargs):
         args = ''
         network = cliargs.get('network', None)
@@ -232,10 +266,9 @@ class Network(RockerExtension):
 
     @staticmethod
     def register_arguments(parser, defaults):
-        client = get_docker_client()
-        parser.add_argument('--network', choices=[n['Name'] for n in client.networks()],
+        parser.add_argument('--network',
             default=defaults.get('network', None),
-            help="What network configuration to use.")
+            help="What network configuration to use, one of the networks listed by `docker network ls`.")
 
 
 class Port(RockerExtension):
@@ -273,6 +306,9 @@ class PulseAudio(RockerExtension):
         self._env_subs = None
         self.name = PulseAudio.get_name()
 
+    def get_volatility(self, cliargs):
+        # The client configuration contains the user id
+        return VOLATILITY_USER
 
     def get_environment_subs(self):
         if not self._env_subs:
@@ -286,8 +322,7 @@ class PulseAudio(RockerExtension):
         return ''
 
     def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name).decode('utf-8')
-        return empy_expand(snippet, self.get_environment_subs())
+        return expand_template('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name, self.get_environment_subs())
 
     def get_docker_args(self, cliargs):
         args = ' -v /run/user/%(user_id)s/pulse:/run/user/%(user_id)s/pulse --device /dev/snd '\
@@ -321,6 +356,51 @@ class HomeDir(RockerExtension):
             help="mount the users home directory")
 
 
+@functools.lru_cache(maxsize=None)
+def get_group_by_gid(gid):
+    """Return the grp entry of a gid or None if it does not exist, memoized for the process."""
+    try:
+        return grp.getgrgid(gid)
+    except KeyError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_group_by_name(name):
+    """Return the grp entry of a group name or None if it does not exist, memoized for the process."""
+    try:
+        return grp.getgrnam(name)
+    except KeyError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_supplementary_groups(user_name, gid):
+    """Return the grp entries of the groups of a user other than its primary group gid."""
+    groups = []
+    for group_gid in sorted(set(os.getgrouplist(user_name, gid))):
+        if group_gid == gid:
+            continue
+        group = get_group_by_gid(group_gid)
+        if group is not None:
+            groups.append(group)
+    return tuple(groups)
+
+
+# Location of the runtime user mapping files in the build context, image and container
+USER_ENTRYPOINT_FILE = 'rocker_user_entrypoint.sh'
+USER_ENTRYPOINT_PATH = '/usr/local/bin/rocker-user-entrypoint'
+USER_MAPPING_MOUNT = '/etc/rocker/user'
+
+# How files of an existing user replaced by the user extension are handed over
+USER_OWNERSHIP_FIX_BOUNDED = 'bounded'
+USER_OWNERSHIP_FIX_FULL = 'full'
+USER_OWNERSHIP_FIX_NONE = 'none'
+USER_OWNERSHIP_FIXES = [USER_OWNERSHIP_FIX_BOUNDED, USER_OWNERSHIP_FIX_FULL, USER_OWNERSHIP_FIX_NONE]
+# Searched in addition to the home directory of the replaced user
+USER_OWNERSHIP_FIX_PATHS = ['/home', '/opt', '/srv', '/tmp', '/usr/local', '/var']
+
+
 class User(RockerExtension):
     @staticmethod
     def get_name():
@@ -337,10 +417,30 @@ class User(RockerExtension):
 
     def __init__(self):
         self._env_subs = None
+        self._user_directory = None
+        self._user_tempdir = None
         self.name = User.get_name()
 
+    @staticmethod
+    def get_user_mapping(cliargs):
+        return cliargs.get('user_mapping') or USER_MAPPING_BUILD
+
+    def get_volatility(self, cliargs):
+        if self.get_user_mapping(cliargs) == USER_MAPPING_RUNTIME:
+            # The user is only added when the container starts
+            return VOLATILITY_STABLE
+        return VOLATILITY_USER
+
+    def get_apt_packages(self, cliargs):
+        # make sure sudo is installed to be able to give user sudo access in docker
+        return ['sudo']
+
     def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name).decode('utf-8')
+        if self.get_user_mapping(cliargs) == USER_MAPPING_RUNTIME:
+            return self.get_runtime_snippet(cliargs)
+        return expand_template('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name, self.get_user_substitutions(cliargs))
+
+    def get_user_substitutions(self, cliargs):
         substitutions = self.get_environment_subs()
         if 'user_override_name' in cliargs and cliargs['user_override_name']:
             substitutions['name'] = cliargs['user_override_name']
@@ -348,16 +448,16 @@ class User(RockerExtension):
         substitutions['user_preserve_home'] = True if 'user_preserve_home' in cliargs and cliargs['user_preserve_home'] else False
         if 'user_preserve_groups' in cliargs and isinstance(cliargs['user_preserve_groups'], list):
             query_groups = cliargs['user_preserve_groups']
-            all_groups = grp.getgrall()
+            # Groups are looked up individually, enumerating all groups can be very slow with directory services
             if query_groups:
-                matched_groups = [g for g in all_groups if g.gr_name in query_groups]
+                matched_groups = [g for g in (get_group_by_name(n) for n in query_groups) if g is not None]
                 matched_group_names = [g.gr_name for g in matched_groups]
                 unmatched_groups = [n for n in cliargs['user_preserve_groups'] if n not in matched_group_names]
                 if unmatched_groups:
                     print('Warning skipping groups %s because they do not exist on the host.' % unmatched_groups)
                 substitutions['user_groups'] = ' '.join(['{};{}'.format(g.gr_name, g.gr_gid) for g in matched_groups])
             else:
-                matched_groups = [g for g in all_groups if substitutions['name'] in g.gr_mem]
+                matched_groups = get_supplementary_groups(pwd.getpwuid(os.getuid()).pw_name, os.getgid())
                 if not matched_groups:
                     print('User %s is not a member of any supplementary groups, skipping group preservation.' % substitutions['name'])
                 substitutions['user_groups'] = ' '.join(['{};{}'.format(g.gr_name, g.gr_gid) for g in matched_groups])
@@ -365,12 +465,78 @@ class User(RockerExtension):
             substitutions['user_groups'] = ''
         substitutions['user_preserve_groups_permissive'] = True if 'user_preserve_groups_permissive' in cliargs and cliargs['user_preserve_groups_permissive'] else False
         substitutions['home_extension_active'] = True if 'home' in cliargs and cliargs['home'] else False
+        substitutions['user_ownership_fix'] = cliargs.get('user_ownership_fix') or USER_OWNERSHIP_FIX_BOUNDED
+        substitutions['ownership_fix_paths'] = USER_OWNERSHIP_FIX_PATHS
         if 'user_override_shell' in cliargs and cliargs['user_override_shell'] is not None:
             if cliargs['user_override_shell'] == '':
                 substitutions['shell'] = None
             else:
                 substitutions['shell'] =  cliargs['user_override_shell']
-        return empy_expand(snippet, substitutions)
+        return substitutions
+
+    def get_runtime_snippet(self, cliargs):
+        entrypoint = [USER_ENTRYPOINT_PATH]
+        cmd = None
+        render = cliargs.get('mode') == OPERATIONS_RENDER
+        if not render:
+            # Chain the entrypoint of the base image and keep its command
+            base_config = get_image_config(cliargs['base_image'])
+            if base_config:
+                entrypoint += base_config.get('Entrypoint') or []
+                cmd = base_config.get('Cmd')
+        return expand_template('rocker', 'templates/%s_runtime_snippet.Dockerfile.em' % self.name, {
+            'entrypoint_file': USER_ENTRYPOINT_FILE,
+            'entrypoint': json.dumps(entrypoint),
+            'cmd': json.dumps(cmd) if cmd else None,
+            'render_base_image': cliargs.get('base_image', '<base image>') if render else None})
+
+    def get_files(self, cliargs):
+        if self.get_user_mapping(cliargs) != USER_MAPPING_RUNTIME:
+            return {}
+        return {USER_ENTRYPOINT_FILE: expand_template('rocker', 'templates/%s_entrypoint.sh.em' % self.name,
+            {'user_mapping_mount': USER_MAPPING_MOUNT})}
+
+    def get_user_fragments(self, cliargs):
+        """Return the passwd, group and sudoers entries of the user for the runtime user mapping."""
+        substitutions = self.get_user_substitutions(cliargs)
+        gecos = re.sub(r'[:\n]', ' ', substitutions['gecos'])
+        groups = ['%s:x:%s:' % (substitutions['name'], substitutions['gid'])]
+        for groupinfo in substitutions['user_groups'].split():
+            group_name, group_gid = groupinfo.split(';')
+            if group_gid != str(substitutions['gid']):
+                groups.append('%s:x:%s:' % (group_name, group_gid))
+        return {
+            'passwd': '%(name)s:x:%(uid)s:%(gid)s:%(gecos)s:%(dir)s:%(shell)s\n' % dict(
+                substitutions, gecos=gecos, shell=substitutions['shell'] or ''),
+            'group': '\n'.join(groups) + '\n',
+            'sudoers': '%s ALL=NOPASSWD: ALL\n' % substitutions['name'],
+        }
+
+    def precondition_environment(self, cliargs):
+        if self.get_user_mapping(cliargs) != USER_MAPPING_RUNTIME or cliargs.get('mode') == OPERATIONS_RENDER:
+            return
+        if not self._user_directory:
+            if cliargs.get('nocleanup'):
+                self._user_directory = tempfile.mkdtemp(prefix='rocker-user-')
+            else:
+                self._user_tempdir = tempfile.TemporaryDirectory(prefix='rocker-user-')
+                self._user_directory = self._user_tempdir.name
+            # Readable by root in the container also with user namespaces
+            os.chmod(self._user_directory, 0o755)
+        for file_name, contents in self.get_user_fragments(cliargs).items():
+            file_path = os.path.join(self._user_directory, file_name)
+            with open(file_path, 'w') as fh:
+                fh.write(contents)
+            os.chmod(file_path, 0o644)
+
+    def get_docker_args(self, cliargs):
+        if self.get_user_mapping(cliargs) != USER_MAPPING_RUNTIME:
+            return ''
+        if cliargs.get('mode') == OPERATIONS_RENDER:
+            return ' -v <user mapping directory>:%s:ro' % USER_MAPPING_MOUNT
+        if not self._user_directory:
+            self.precondition_environment(cliargs)
+        return ' -v %s:%s:ro' % (self._user_directory, USER_MAPPING_MOUNT)
 
     @staticmethod
     def register_arguments(parser, defaults):
@@ -396,6 +562,17 @@ class User(RockerExtension):
             default=defaults.get('user-preserve-groups-permissive', False),
             help="If using user-preserve-groups allow failures in assignment."
                  "This is important if the host and target have different rules. https://unix.stackexchange.com/a/11481/83370" )
+        parser.add_argument('--user-ownership-fix',
+            choices=USER_OWNERSHIP_FIXES,
+            default=defaults.get('user-ownership-fix', USER_OWNERSHIP_FIX_BOUNDED),
+            help="How to hand over the files of an existing user with the same name but a different uid. "
+                 "bounded searches the old home directory and %s, full the whole root filesystem "
+                 "and none leaves the ownership unchanged." % ', '.join(USER_OWNERSHIP_FIX_PATHS))
+        parser.add_argument('--user-mapping',
+            choices=USER_MAPPINGS,
+            default=defaults.get('user-mapping', USER_MAPPING_BUILD),
+            help="build creates the user in the image. runtime adds the user when the container starts "
+                 "so that one image can be shared by all users of a host.")
         parser.add_argument('--user-override-shell',
             action='store',
             default=defaults.get('user-override-shell', None),
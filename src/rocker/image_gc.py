@@ -0,0 +1,161 @@
+# Copyright 2026 Open Source Robotics Foundation
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import re
+import time
+
+from .core import DependencyMissing
+from .core import LABEL_BUILT_AT
+from .core import LABEL_CONFIG_HASH
+from .core import docker_remove_image
+from .core import forget_image_usage
+from .core import get_docker_client
+from .core import get_image_usage
+
+
+SIZE_UNITS = {'': 1, 'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3, 't': 1000 ** 4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_size(text):
+    """Parse a size like 500M or 20G into bytes."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmgt]?)b?', text.strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}', expected a number with an optional K, M, G or T suffix")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_age(text):
+    """Parse an age like 12h or 7d into seconds."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([smhdw]?)', text.strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid age '{text}', expected a number with an optional s, m, h, d or w suffix")
+    return float(match.group(1)) * AGE_UNITS[match.group(2) or 's']
+
+
+def _short_id(image_id):
+    return image_id.split(':')[-1][:12]
+
+
+def list_rocker_images(docker_client):
+    """Return the images built by rocker, least recently used first.
+
+    Each entry is a dict with the id, tags, size, config_hash and the time of
+    the last use. Images never used since the build count as used when built."""
+    usage = {_short_id(image_id): entry for image_id, entry in get_image_usage().items()}
+    images = []
+    for image in docker_client.images(filters={'label': LABEL_CONFIG_HASH}):
+        labels = image.get('Labels') or {}
+        try:
+            built_at = float(labels.get(LABEL_BUILT_AT))
+        except (TypeError, ValueError):
+            built_at = image.get('Created', 0)
+        last_used = usage.get(_short_id(image['Id']), {}).get('last_used', built_at)
+        images.append({
+            'id': image['Id'],
+            'tags': [t for t in image.get('RepoTags') or [] if t != '<none>:<none>'],
+            'size': image.get('Size', 0),
+            'config_hash': labels.get(LABEL_CONFIG_HASH),
+            'last_used': max(last_used, built_at),
+        })
+    images.sort(key=lambda i: i['last_used'])
+    return images
+
+
+def get_images_in_use(docker_client):
+    """Return the ids of the images backing existing containers."""
+    return {c['ImageID'] for c in docker_client.containers(all=True) if c.get('ImageID')}
+
+
+def select_images_to_remove(images, in_use, max_age=None, max_size=None, now=None):
+    """Select the images to evict from a least recently used first list.
+
+    Images not used for longer than max_age seconds are evicted first, then
+    the least recently used images until the total size is within max_size
+    bytes. Images in use by a container are never selected but count towards
+    the total size."""
+    if now is None:
+        now = time.time()
+    selected = []
+    total_size = sum(i['size'] for i in images)
+    for image in images:
+        if image['id'] in in_use:
+            continue
+        expired = max_age is not None and now - image['last_used'] > max_age
+        over_budget = max_size is not None and total_size > max_size
+        if expired or over_budget:
+            selected.append(image)
+            total_size -= image['size']
+    return selected
+
+
+def collect_garbage(max_age=None, max_size=None, dry_run=False, docker_client=None):
+    """Remove images built by rocker according to the age and size budgets.
+
+    Returns the number of images which could not be removed."""
+    if docker_client is None:
+        docker_client = get_docker_client()
+    images = list_rocker_images(docker_client)
+    in_use = get_images_in_use(docker_client)
+    total_size = sum(i['size'] for i in images)
+    print(f"Found {len(images)} images built by rocker using {total_size / 1000 ** 2:.1f} MB, "
+          f"{len([i for i in images if i['id'] in in_use])} of them used by containers")
+
+    failures = 0
+    removed = []
+    for image in select_images_to_remove(images, in_use, max_age=max_age, max_size=max_size):
+        description = '%s %s (%.1f MB, last used %s)' % (
+            _short_id(image['id']), ' '.join(image['tags']), image['size'] / 1000 ** 2,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(image['last_used'])))
+        if dry_run:
+            print(f"Would remove image {description}")
+            continue
+        print(f"Removing image {description}")
+        # Forced to remove all tags of the image at once
+        if docker_remove_image(image['id'], docker_client=docker_client, fail_on_error=True, force=True):
+            removed.append(image['id'])
+        else:
+            print(f"Failed to remove image {_short_id(image['id'])} it likely has child images.")
+            failures += 1
+
+    if not dry_run:
+        # Also drop the usage of images which were removed by other means
+        present = {_short_id(i['id']) for i in images} - {_short_id(i) for i in removed}
+        forget_image_usage([i for i in get_image_usage() if _short_id(i) not in present])
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='rocker gc',
+        description='Remove images built by rocker, least recently used first. '
+        'Images used by containers are kept.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--max-age', type=parse_age, default=None,
+        help='Remove images not used for longer than this, e.g. 12h or 7d')
+    parser.add_argument('--max-size', type=parse_size, default=None,
+        help='Remove the least recently used images until the images built by rocker use less than this, e.g. 20G. '
+        'Layers shared between images are counted for every image.')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Only print the images which would be removed')
+    args = parser.parse_args(argv)
+    if args.max_age is None and args.max_size is None:
+        parser.error('At least one of --max-age and --max-size is required')
+
+    try:
+        docker_client = get_docker_client()
+    except DependencyMissing as ex:
+        parser.error(str(ex))
+    return 1 if collect_garbage(args.max_age, args.max_size, args.dry_run, docker_client) else 0
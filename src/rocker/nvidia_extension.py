@@ -15,8 +15,6 @@
 import os
 import getpass
 import tempfile
-from packaging.version import Version
-import pkgutil
 from pathlib import Path
 import subprocess
 import sys
@@ -24,9 +22,12 @@ import sys
 from .os_detector import detect_os
 
 from .extensions import name_to_argument
-from .core import get_docker_client
+from .core import get_apt_cache_mounts
+from .core import get_daemon_info
+from .core import OPERATIONS_RENDER
 from .core import RockerExtension
-from .em import empy_expand
+from .core import VOLATILITY_STABLE
+from .em import expand_template
 
 
 def has_nvidia_driver():
@@ -52,7 +53,8 @@ GLVND_VERSION_POLICY_LATEST_LTS='latest_lts'
 NVIDIA_GLVND_VALID_VERSIONS=['16.04', '18.04','20.04', '22.04', '24.04']
 
 def get_docker_version():
-    docker_version_raw = get_docker_client().version()['Version']
+    from packaging.version import Version
+    docker_version_raw = get_daemon_info()['version']
     # Fix for version 17.09.0-ce
     return Version(docker_version_raw.split('-')[0])
 
@@ -81,14 +83,20 @@ class X11(RockerExtension):
     def get_name():
         return 'x11'
 
+    # The docker arguments refer to the xauth file of the latest precondition_environment
+    memoize_hooks = False
+
     def __init__(self):
         self.name = X11.get_name()
         self._env_subs = None
         self._xauth = None
 
     def get_docker_args(self, cliargs):
-        assert self._xauth, 'xauth not initialized, get_docker_args must be called after precodition_environment'
-        xauth = self._xauth.name
+        if cliargs.get('mode') == OPERATIONS_RENDER:
+            xauth = '<xauth file>'
+        else:
+            assert self._xauth, 'xauth not initialized, get_docker_args must be called after precodition_environment'
+            xauth = self._xauth.name
         return "  -e DISPLAY -e TERM \
   -e QT_X11_NO_MITSHM=1 \
   -e XAUTHORITY=%(xauth)s -v %(xauth)s:%(xauth)s \
@@ -96,6 +104,8 @@ class X11(RockerExtension):
   -v /etc/localtime:/etc/localtime:ro " % locals()
 
     def precondition_environment(self, cliargs):
+        if cliargs.get('mode') == OPERATIONS_RENDER:
+            return
         self._xauth = tempfile.NamedTemporaryFile(prefix='.docker', suffix='.xauth', delete=not cliargs.get('nocleanup'))
         xauth = self._xauth.name
         display = os.getenv('DISPLAY')
@@ -125,12 +135,18 @@ class Nvidia(RockerExtension):
     def get_name():
         return 'nvidia'
 
+    # The distribution of the base image is detected in a container
+    render_requires_daemon = True
+
     def __init__(self):
         self._env_subs = None
         self.name = Nvidia.get_name()
         self.supported_distros = ['Ubuntu', 'Debian GNU/Linux']
         self.supported_versions = ['16.04', '18.04', '20.04', '10', '22.04', '24.04']
 
+    def get_volatility(self, cliargs):
+        return VOLATILITY_STABLE
+
 
     def get_environment_subs(self, cliargs={}):
         if not self._env_subs:
@@ -173,14 +189,19 @@ class Nvidia(RockerExtension):
                            "         The container may not have access to GPU hardware.")
 
     def get_preamble(self, cliargs):
-        preamble = pkgutil.get_data('rocker', 'templates/%s_preamble.Dockerfile.em' % self.name).decode('utf-8')
-        return empy_expand(preamble, self.get_environment_subs(cliargs))
+        return expand_template('rocker', 'templates/%s_preamble.Dockerfile.em' % self.name, self.get_environment_subs(cliargs))
 
     def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name).decode('utf-8')
-        return empy_expand(snippet, self.get_environment_subs(cliargs))
+        return expand_template('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name, self.get_environment_subs(cliargs))
+
+    def get_apt_packages(self, cliargs):
+        if self.get_environment_subs(cliargs)['image_distro_version'] == '16.04':
+            # GL support is copied from the glvnd image on xenial
+            return []
+        return ['libglvnd0', 'libgl1', 'libglx0', 'libegl1', 'libgles2']
 
     def get_docker_args(self, cliargs):
+        from packaging.version import Version
         force_flag = cliargs.get('nvidia', None)
         if force_flag == 'runtime':
             return "  --runtime=nvidia"
@@ -212,12 +233,18 @@ class Cuda(RockerExtension):
     def get_name():
         return 'cuda'
 
+    # The distribution of the base image is detected in a container
+    render_requires_daemon = True
+
     def __init__(self):
         self._env_subs = None
         self.name = Cuda.get_name()
         self.supported_distros = ['Ubuntu', 'Debian GNU/Linux']
         self.supported_versions = ['20.04', '22.04', '24.04', '11', '12'] # Debian 11 and 12
 
+    def get_volatility(self, cliargs):
+        return VOLATILITY_STABLE
+
     def get_environment_subs(self, cliargs={}):
         if not self._env_subs:
             self._env_subs = {}
@@ -234,6 +261,7 @@ class Cuda(RockerExtension):
         self._env_subs['download_osstring'] = dist.split()[0].lower()
         self._env_subs['download_verstring'] = ver.replace('.', '')
         self._env_subs['download_keyid'] = '3bf863cc'
+        self._env_subs['apt_cache_mounts'] = get_apt_cache_mounts(cliargs)
 
         self._env_subs['image_distro_id'] = dist
         if self._env_subs['image_distro_id'] not in self.supported_distros:
@@ -260,12 +288,14 @@ class Cuda(RockerExtension):
 
     def get_preamble(self, cliargs):
         return ''
-        # preamble = pkgutil.get_data('rocker', 'templates/%s_preamble.Dockerfile.em' % self.name).decode('utf-8')
-        # return empy_expand(preamble, self.get_environment_subs(cliargs))
+        # return expand_template('rocker', 'templates/%s_preamble.Dockerfile.em' % self.name, self.get_environment_subs(cliargs))
 
     def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name).decode('utf-8')
-        return empy_expand(snippet, self.get_environment_subs(cliargs))
+        return expand_template('rocker', 'templates/%s_snippet.Dockerfile.em' % self.name, self.get_environment_subs(cliargs))
+
+    def get_apt_packages(self, cliargs):
+        # Prerequisites for adding the CUDA repository
+        return ['wget', 'software-properties-common', 'gnupg2']
 
     def get_docker_args(self, cliargs):
         return ""
@@ -12,91 +12,126 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
-import pexpect
+import io
+import posixpath
+import shlex
+import tarfile
 
-from io import BytesIO as StringIO
+from .core import base_image_exists, get_docker_client, get_image_id, json_cache
 
-from .core import base_image_exists, DependencyMissing, docker_build, get_docker_client
 
+# Locations of the os-release file in order of precedence as defined in os-release(5)
+OS_RELEASE_PATHS = ['/etc/os-release', '/usr/lib/os-release']
 
-DETECTOR_IMAGE = "golang:1.19"
-
-DETECTION_TEMPLATE="""
-FROM %(detector_image)s as detector
-
-# For reliability, pin a distro-detect commit instead of targeting a branch.
-RUN git clone -q https://github.com/dekobon/distro-detect.git && \
-    cd distro-detect && \
-    git checkout -q 5f5b9c724b9d9a117732d2a4292e6288905734e1 && \
-    CGO_ENABLED=0 go build .
-
-FROM %(image_name)s
-
-COPY --from=detector /go/distro-detect/distro-detect /tmp/detect_os
-ENTRYPOINT [ "/tmp/detect_os", "-format", "json-one-line" ]
-CMD [ "" ]
-"""
+OS_DETECT_CACHE_FILE = 'os_detect_cache.json'
 
+# Results of detection keyed by the image id of the detected image
 _detect_os_cache = dict()
 
-def detect_os(image_name, output_callback=None, nocache=False):
-    # Do not rerun OS detection if there is already a cached result for the given image
-    if image_name in _detect_os_cache:
-        return _detect_os_cache[image_name]
-
-    detector_image = DETECTOR_IMAGE
-    if not base_image_exists(detector_image, output_callback=output_callback):
-        raise DependencyMissing(
-            f"OS detector helper image '{detector_image}' was not found in the container "
-            f"registry. Verify the image name or try 'docker pull {detector_image}'."
-        )
-
-    iof = StringIO((DETECTION_TEMPLATE % locals()).encode())
-    tag_name = "rocker:" + f"os_detect_{image_name}".replace(':', '_').replace('/', '_')
-    image_id = docker_build(
-        fileobj=iof,
-        output_callback=output_callback,
-        nocache=nocache,
-        forcerm=True,  # Remove intermediate containers from RUN commands in DETECTION_TEMPLATE
-        tag=tag_name
-    )
-    if not image_id:
+def detect_os(image_name, output_callback=None, nocache=False, docker_client=None):
+    """Detect the distribution of an image and return a tuple of (dist, ver, codename).
+
+    Results are cached in memory and on disk keyed by the content id of the image,
+    so a tag which moves to a new image is detected again. Use nocache to force
+    detection. Returns None if the image is not available or detection fails."""
+    import docker
+    if docker_client is None:
+        docker_client = get_docker_client()
+
+    try:
+        image_id = get_image_id(image_name, docker_client=docker_client)
+        if image_id is None:
+            if not base_image_exists(image_name, docker_client=docker_client, output_callback=output_callback):
+                return None
+            image_id = get_image_id(image_name, docker_client=docker_client)
+    except docker.errors.APIError as ex:
         if output_callback:
-            output_callback('Failed to build detector image')
+            output_callback("Unable to resolve image '%s': %s" % (image_name, ex))
         return None
 
-    cmd="docker run -it --rm %s" % image_id
-    if output_callback:
-        output_callback("running, ", cmd)
-    p = pexpect.spawn(cmd)
-    output = p.read().decode()
-    if output_callback:
-        output_callback("output: ", output)
-    p.terminate()
-
-    # Clean up the image
-    client = get_docker_client()
-    client.remove_image(image=tag_name)
-
-    if p.exitstatus == 0:
+    # Do not rerun OS detection if there is already a cached result for the given image
+    if not nocache:
+        if image_id in _detect_os_cache:
+            return _detect_os_cache[image_id]
+        try:
+            with json_cache(OS_DETECT_CACHE_FILE) as cache:
+                cached_result = cache.get(image_id)
+        except OSError:
+            cached_result = None
+        if cached_result:
+            _detect_os_cache[image_id] = tuple(cached_result)
+            return _detect_os_cache[image_id]
+
+    result = _run_detection(image_name, docker_client, output_callback)
+    if result is None:
+        return None
+    _detect_os_cache[image_id] = result
+    try:
+        with json_cache(OS_DETECT_CACHE_FILE) as cache:
+            cache[image_id] = list(result)
+    except OSError as ex:
+        if output_callback:
+            output_callback("Unable to write os detection cache: %s" % ex)
+    return result
+
+def parse_os_release(content):
+    """Parse the content of an os-release file into a dict."""
+    fields = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
         try:
-            detect_dict = json.loads(output.strip())
+            value = ' '.join(shlex.split(value))
         except ValueError:
+            value = value.strip('"\'')
+        fields[key] = value
+    return fields
+
+def read_container_file(docker_client, container, path, max_links=8):
+    """Read a file out of a container following symlinks within the container filesystem."""
+    for _ in range(max_links):
+        bits, _stat = docker_client.get_archive(container, path)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(bits))) as tar:
+            member = tar.next()
+            if member is None:
+                return None
+            if member.issym():
+                path = posixpath.normpath(posixpath.join(posixpath.dirname(path), member.linkname))
+                continue
+            fh = tar.extractfile(member)
+            if fh is None:
+                return None
+            return fh.read().decode('utf-8', errors='replace')
+    return None
+
+def _run_detection(image_name, docker_client, output_callback):
+    import docker
+    # The container is created but never started, no command will be executed
+    container = docker_client.create_container(image_name, command=['/bin/true'])
+    try:
+        for path in OS_RELEASE_PATHS:
+            try:
+                content = read_container_file(docker_client, container['Id'], path)
+            except docker.errors.NotFound:
+                content = None
+            if content is not None:
+                break
             if output_callback:
-                output_callback('Failed to parse JSON')
-            return None
-
-        dist = detect_dict.get('name', '')
-        os_release = detect_dict.get('os_release', {})
-        ver = os_release.get('VERSION_ID', '')
-        codename = os_release.get('VERSION_CODENAME', '')
+                output_callback("%s not found in image '%s'" % (path, image_name))
+    finally:
+        docker_client.remove_container(container['Id'], force=True)
 
-        _detect_os_cache[image_name] = (dist, ver, codename)
-        return _detect_os_cache[image_name]
-    else:
+    if content is None:
         if output_callback:
-            output_callback("/tmp/detect_os failed:")
-            for l in output.splitlines():
-                output_callback("> %s" % l)
+            output_callback("Unable to find an os-release file in image '%s'" % image_name)
         return None
+
+    os_release = parse_os_release(content)
+    if output_callback:
+        output_callback("os-release: %s" % os_release)
+    dist = os_release.get('NAME', '')
+    ver = os_release.get('VERSION_ID', '')
+    codename = os_release.get('VERSION_CODENAME', os_release.get('UBUNTU_CODENAME', ''))
+    return (dist, ver, codename)
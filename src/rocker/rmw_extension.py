@@ -14,9 +14,8 @@
 
 from argparse import ArgumentTypeError
 import os
-import pkgutil
 
-from .em import empy_expand
+from rocker.core import VOLATILITY_STABLE
 from rocker.extensions import RockerExtension
 from rocker.extensions import name_to_argument
 
@@ -43,6 +42,9 @@ class RMW(RockerExtension):
         self._env_subs = None
         self.name = RMW.get_name()
 
+    def get_volatility(self, cliargs):
+        return VOLATILITY_STABLE
+
     def get_docker_args(self, cli_args):
         rmw_config = cli_args.get('rmw')
         if not rmw_config:
@@ -59,19 +61,13 @@ class RMW(RockerExtension):
     def get_preamble(self, cliargs):
         return ''
 
-    def get_snippet(self, cliargs):
-        snippet = pkgutil.get_data('rocker', 'templates/%s_snippet.Dockerfile.em' % RMW.get_name()).decode('utf-8')
-        data = self.get_environment_subs()
-        # data['rosdistro'] = cliargs.get('rosdistro', 'rolling')
+    def get_apt_packages(self, cliargs):
         rmw = cliargs.get('rmw', None)
-        if rmw:
-            rmw = rmw[0]
-        else:
-            return '' # rmw not active
-        data['rmw'] = rmw
-        data['packages'] = RMW.get_package_names(rmw)
-        # data['rosdistro'] = 'rolling'
-        return empy_expand(snippet, data)
+        if not rmw:
+            return [] # rmw not active
+        # Fail the build with an explicit message if ROS_DISTRO is not set in the image
+        return [p.replace('${ROS_DISTRO}', '${ROS_DISTRO:?ROS_DISTRO is unset cannot override RMW}')
+                for p in RMW.get_package_names(rmw[0])]
 
     @staticmethod
     def register_arguments(parser, defaults):
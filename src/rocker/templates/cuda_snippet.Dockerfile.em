@@ -6,15 +6,10 @@
 # TODO(tfoote) make this more generic/shared across instances
 ARG DEBIAN_FRONTEND=noninteractive
 
-# Prerequisites
-RUN apt-get update && apt-get install -y --no-install-recommends \
-    wget software-properties-common gnupg2 \
-    && rm -rf /var/lib/apt/lists/*
-
 # Detect if NVIDIA is already installed in the container at build time.
 # If present, skip CUDA installation to avoid reinstalling.
 # This addresses issue #316 where CUDA was being unnecessarily reinstalled.
-RUN if ldconfig -p | grep -q libcuda.so || [ -f /proc/driver/nvidia/version ]; then \
+RUN @(apt_cache_mounts)if ldconfig -p | grep -q libcuda.so || [ -f /proc/driver/nvidia/version ]; then \
       echo "NVIDIA detected inside container, skipping CUDA install"; \
     else \
       echo "NVIDIA not detected inside container, installing CUDA"; \
@@ -28,7 +23,7 @@ RUN if ldconfig -p | grep -q libcuda.so || [ -f /proc/driver/nvidia/version ]; t
 @[end if]@
       apt-get update && \
       apt-get -y install cuda-toolkit && \
-      rm -rf /var/lib/apt/lists/* && \
+      @('true' if apt_cache_mounts else 'rm -rf /var/lib/apt/lists/*') && \
       # File conflict problem with libnvidia-ml.so.1 and libcuda.so.1
       # https://github.com/NVIDIA/nvidia-docker/issues/1551
       rm -rf /usr/lib/x86_64-linux-gnu/libnv* && \
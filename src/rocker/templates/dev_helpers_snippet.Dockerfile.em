@@ -1,6 +0,0 @@
-# workspace development helpers
-RUN apt-get update \
- && apt-get install -y \
-    byobu \
-    emacs \
- && apt-get clean
@@ -0,0 +1,57 @@
+#!/bin/sh
+# Entrypoint of images built with rocker --user --user-mapping runtime.
+# If rocker mounted the account of the invoking user it is added to the
+# account databases and the command is executed as that user.
+# Without the mount the command is executed unchanged.
+set -e
+
+user_dir="@(user_mapping_mount)"
+if [ "$(id -u)" != "0" ] || [ ! -f "${user_dir}/passwd" ]; then
+    exec "$@@"
+fi
+
+IFS=: read -r user_name _ user_uid user_gid _ user_home user_shell < "${user_dir}/passwd"
+
+# Replace any account with the same name or uid, fields are compared literally
+awk -F: -v n="${user_name}" -v u="${user_uid}" '$1 != n && $3 != u' /etc/passwd > /etc/passwd.rocker
+cat "${user_dir}/passwd" >> /etc/passwd.rocker
+cat /etc/passwd.rocker > /etc/passwd
+rm -f /etc/passwd.rocker
+
+# Create missing groups and add the user to the others
+while IFS=: read -r group_name _ group_gid _; do
+    awk -F: -v OFS=: -v name="${group_name}" -v g="${group_gid}" -v n="${user_name}" '
+        $3 == g {
+            found = 1
+            member = 0
+            count = split($4, members, ",")
+            for (i = 1; i <= count; i++) if (members[i] == n) member = 1
+            if (!member) $4 = ($4 == "" ? n : $4 "," n)
+        }
+        { print }
+        END { if (!found) print name, "x", g, n }' /etc/group > /etc/group.rocker
+    cat /etc/group.rocker > /etc/group
+    rm -f /etc/group.rocker
+done < "${user_dir}/group"
+
+if [ -d /etc/sudoers.d ]; then
+    cat "${user_dir}/sudoers" > /etc/sudoers.d/rocker-user
+    chmod 0440 /etc/sudoers.d/rocker-user
+fi
+
+# Making sure a home directory exists if the user's home directory is not mounted
+if [ ! -d "${user_home}" ]; then
+    mkdir -p "${user_home}"
+    cp -a /etc/skel/. "${user_home}/" 2>/dev/null || true
+    chown -R "${user_uid}:${user_gid}" "${user_home}"
+fi
+cd "${user_home}"
+
+export HOME="${user_home}" USER="${user_name}" LOGNAME="${user_name}"
+if [ $# -eq 0 ]; then
+    set -- "${user_shell:-/bin/sh}"
+fi
+if command -v setpriv >/dev/null; then
+    exec setpriv --reuid="${user_uid}" --regid="${user_gid}" --init-groups "$@@"
+fi
+exec sudo -E -u "${user_name}" -- "$@@"
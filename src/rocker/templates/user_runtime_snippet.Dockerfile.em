@@ -0,0 +1,12 @@
+# The invoking user is added when the container starts so that the image does not depend on the user
+COPY @(entrypoint_file) /usr/local/bin/rocker-user-entrypoint
+RUN chmod 755 /usr/local/bin/rocker-user-entrypoint
+@[if render_base_image]@
+# Rendered without the docker daemon: when building, the ENTRYPOINT of @(render_base_image)
+# is appended after the rocker entrypoint and its CMD is set again
+@[end if]@
+ENTRYPOINT @(entrypoint)
+@[if cmd]@
+# Setting the ENTRYPOINT resets the CMD of the base image
+CMD @(cmd)
+@[end if]@
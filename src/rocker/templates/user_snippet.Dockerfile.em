@@ -1,16 +1,26 @@
-# make sure sudo is installed to be able to give user sudo access in docker
-RUN if ! command -v sudo >/dev/null; then \
-      apt-get update \
-      && apt-get install -y sudo \
-      && apt-get clean; \
-    fi
-
 @[if name != 'root']@
 RUN existing_user_by_uid=`getent passwd "@(uid)" | cut -f1 -d: || true` && \
     if [ -n "${existing_user_by_uid}" ]; then userdel @('' if user_preserve_home else '-r') "${existing_user_by_uid}"; fi && \
     existing_user_by_name=`getent passwd "@(name)" | cut -f1 -d: || true` && \
     existing_user_uid=`getent passwd "@(name)" | cut -f3 -d: || true` && \
-    if [ -n "${existing_user_by_name}" ]; then find / -uid ${existing_user_uid} -exec chown -h @(uid) {} + || true ; find / -gid ${existing_user_uid} -exec chgrp -h @(uid) {} + || true ; fi && \
+@[if user_ownership_fix != 'none']@
+    if [ -n "${existing_user_by_name}" ]; then \
+@[if user_ownership_fix == 'full']@
+      search_paths=/; \
+@[else]@
+      existing_user_home=`getent passwd "@(name)" | cut -f6 -d: || true`; \
+      search_paths=""; \
+      for search_path in "${existing_user_home}" @(' '.join(ownership_fix_paths)); do \
+        case "${search_path}" in @('|'.join(p + '/*' for p in ownership_fix_paths))) continue ;; esac; \
+        if [ -d "${search_path}" ]; then search_paths="${search_paths} ${search_path}"; fi; \
+      done; \
+@[end if]@
+      if [ -n "${search_paths}" ]; then \
+        find ${search_paths} -xdev \( -path /proc -o -path /sys \) -prune -o -uid ${existing_user_uid} -exec chown -h @(uid) {} + || true ; \
+        find ${search_paths} -xdev \( -path /proc -o -path /sys \) -prune -o -gid ${existing_user_uid} -exec chgrp -h @(uid) {} + || true ; \
+      fi; \
+    fi && \
+@[end if]@
     if [ -n "${existing_user_by_name}" ]; then userdel @('' if user_preserve_home else '-r') "${existing_user_by_name}"; fi && \
     existing_group_by_gid=`getent group "@(gid)" | cut -f1 -d: || true` && \
     if [ -z "${existing_group_by_gid}" ]; then \
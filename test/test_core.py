@@ -16,24 +16,45 @@
 # under the License.
 
 import argparse
+import contextlib
 import docker
 import em
+import io
+import json
 import os
 import pwd
 import pytest
+import rocker.core
+import rocker.extensions
+import sys
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from itertools import chain
 
 from rocker.core import DockerImageGenerator
 from rocker.core import ExtensionError
 from rocker.core import base_image_exists
+from rocker.core import call_extension_hook
+from rocker.core import clear_entry_point_index
+from rocker.core import docker_buildx_build
 from rocker.core import list_plugins
+from rocker.core import load_manifest
+from rocker.core import run_manifest
+from rocker.core import write_manifest
+from rocker.core import get_daemon_info
+from rocker.core import get_entry_points
 from rocker.core import get_docker_client
+from rocker.core import set_docker_client
 from rocker.core import get_rocker_version
 from rocker.core import get_user_name
+from rocker.core import LazyExtension
 from rocker.core import RockerExtension
 from rocker.core import RockerExtensionManager
+from rocker.core import VOLATILITY_HOST
+from rocker.core import VOLATILITY_STABLE
+from rocker.core import VOLATILITY_USER
 
 class RockerCoreTest(unittest.TestCase):
 
@@ -225,6 +246,43 @@ class RockerCoreTest(unittest.TestCase):
         self.assertEqual(active_extensions[0].get_name(), 'foo')
         self.assertEqual(active_extensions[1].get_name(), 'bar')
 
+    def test_extension_volatility_sorting(self):
+        def make_extension(extension_name, volatility, after=()):
+            class VolatilityExtension(RockerExtension):
+                @classmethod
+                def get_name(cls):
+                    return extension_name
+
+                def get_volatility(self, cli_args):
+                    return volatility
+
+                def invoke_after(self, cli_args):
+                    return set(after)
+            return VolatilityExtension
+
+        extension_manager = RockerExtensionManager()
+        extension_manager.available_plugins = {
+            'aaa_user': make_extension('aaa_user', VOLATILITY_USER),
+            'bbb_host': make_extension('bbb_host', VOLATILITY_HOST),
+            'ccc_stable': make_extension('ccc_stable', VOLATILITY_STABLE),
+            'ddd_stable': make_extension('ddd_stable', VOLATILITY_STABLE, after=['aaa_user']),
+        }
+        args = {name: True for name in extension_manager.available_plugins}
+        args['extension_blacklist'] = []
+
+        active_extensions = extension_manager.get_active_extensions(args)
+        self.assertEqual([e.get_name() for e in active_extensions], ['aaa_user', 'bbb_host', 'ccc_stable', 'ddd_stable'])
+
+        args['extension_ordering'] = 'cache'
+        active_extensions = extension_manager.get_active_extensions(args)
+        # invoke_after constraints still apply
+        self.assertEqual([e.get_name() for e in active_extensions], ['ccc_stable', 'bbb_host', 'aaa_user', 'ddd_stable'])
+
+        plugins = list_plugins()
+        self.assertEqual(plugins['user']().get_volatility({}), VOLATILITY_USER)
+        self.assertEqual(plugins['dev_helpers']().get_volatility({}), VOLATILITY_STABLE)
+        self.assertEqual(plugins['ssh']().get_volatility({}), VOLATILITY_HOST)
+
     def test_docker_cmd_interactive(self):
         dig = DockerImageGenerator([], {}, 'ubuntu:bionic')
 
@@ -366,3 +424,541 @@ class RockerCoreTest(unittest.TestCase):
 
         self.assertIn("Error while pulling image 'ubuntu:test': nope", outputs)
         self.assertNotIn("Successfully pulled 'ubuntu:test'", outputs)
+
+    def test_config_hash(self):
+        class FileExtension(RockerExtension):
+            def __init__(self, contents):
+                self.contents = contents
+
+            @classmethod
+            def get_name(cls):
+                return 'file_extension'
+
+            def get_files(self, cli_args):
+                return {'payload.bin': self.contents}
+
+        dig = DockerImageGenerator([FileExtension(b'abc')], {}, 'ubuntu:bionic')
+        config_hash = dig.get_config_hash(base_image_id='sha256:1234')
+        self.assertEqual(config_hash, dig.get_config_hash(base_image_id='sha256:1234'))
+        self.assertNotEqual(config_hash, dig.get_config_hash(base_image_id='sha256:5678'))
+
+        other_dig = DockerImageGenerator([FileExtension(b'abd')], {}, 'ubuntu:bionic')
+        self.assertNotEqual(config_hash, other_dig.get_config_hash(base_image_id='sha256:1234'))
+
+    def test_image_cache_hit(self):
+        class FakeDockerClient:
+            def __init__(self):
+                self.tagged = []
+
+            def inspect_image(self, image):
+                return {'Id': 'sha256:cached' if image.startswith('rocker-cache:') else 'sha256:base'}
+
+            def tag(self, image, repository, tag=None):
+                self.tagged.append((image, repository, tag))
+
+        fake_client = FakeDockerClient()
+        dig = DockerImageGenerator([], {}, 'ubuntu:bionic')
+        with patch('rocker.core.get_docker_client', return_value=fake_client), \
+                patch('rocker.core.record_image_usage'):
+            with patch('rocker.core.docker_build') as mock_build:
+                self.assertEqual(dig.build(image_cache=True, image_name='foo:bar'), 0)
+                mock_build.assert_not_called()
+            self.assertTrue(dig.cached)
+            self.assertEqual(dig.image_id, 'sha256:cached')
+            self.assertEqual(fake_client.tagged, [('sha256:cached', 'foo', 'bar')])
+            with patch('rocker.core.docker_remove_image') as mock_remove:
+                dig.clear_image()
+                mock_remove.assert_not_called()
+        self.assertFalse(dig.built)
+
+    def test_image_cache_pull(self):
+        class FakeDockerClient:
+            def __init__(self):
+                self.base_id = 'sha256:stale'
+                self.inspected = []
+
+            def pull(self, image, stream=True, decode=True):
+                self.base_id = 'sha256:fresh'
+                return iter([{'status': 'Status: Downloaded newer image'}])
+
+            def inspect_image(self, image):
+                self.inspected.append(image)
+                if image.startswith('rocker-cache:'):
+                    return {'Id': 'sha256:cached'}
+                return {'Id': self.base_id}
+
+        fake_client = FakeDockerClient()
+        dig = DockerImageGenerator([], {}, 'ubuntu:bionic')
+        with patch('rocker.core.get_docker_client', return_value=fake_client), \
+                patch('rocker.core.record_image_usage'):
+            self.assertEqual(dig.build(image_cache=True, pull=True), 0)
+        # The cache is looked up for the pulled base image, not the stale one
+        fresh_tag = 'rocker-cache:' + dig.get_config_hash(base_image_id='sha256:fresh')
+        self.assertEqual(fake_client.inspected[-1], fresh_tag)
+        self.assertNotIn('rocker-cache:' + dig.get_config_hash(base_image_id='sha256:stale'), fake_client.inspected)
+
+    def test_build_skipped_without_image_content(self):
+        class RuntimeOnly(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'runtime_only'
+
+            def get_docker_args(self, cli_args):
+                return ' --network host'
+
+        class WithSnippet(RuntimeOnly):
+            def get_snippet(self, cli_args):
+                return 'RUN true'
+
+        dig = DockerImageGenerator([RuntimeOnly()], {}, 'ubuntu:bionic')
+        self.assertFalse(dig.requires_build())
+        with patch('rocker.core.docker_build') as mock_build:
+            self.assertEqual(dig.build(), 0)
+            mock_build.assert_not_called()
+        cmd = dig.generate_docker_cmd('true')
+        self.assertIn('--user root', cmd)
+        self.assertIn('--network host ubuntu:bionic true', cmd)
+        with patch('rocker.core.docker_remove_image') as mock_remove:
+            dig.clear_image()
+            mock_remove.assert_not_called()
+
+        self.assertTrue(DockerImageGenerator([WithSnippet()], {}, 'ubuntu:bionic').requires_build())
+        self.assertTrue(DockerImageGenerator([RuntimeOnly()], {'user': True}, 'ubuntu:bionic').requires_build())
+
+    def test_render(self):
+        class RenderExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'render_extension'
+
+            def get_snippet(self, cli_args):
+                return 'COPY payload.txt /payload.txt'
+
+            def get_files(self, cli_args):
+                return {'payload.txt': 'payload content', 'blob.bin': b'\x00\x01'}
+
+            def get_docker_args(self, cli_args):
+                return ' --network host'
+
+        dig = DockerImageGenerator([RenderExtension()], {}, 'ubuntu:bionic')
+        output = io.StringIO()
+        with patch('rocker.core.get_docker_client') as mock_client:
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(dig.render('true', mode='render'), 0)
+            mock_client.assert_not_called()
+        rendered = output.getvalue()
+        self.assertIn('FROM ubuntu:bionic', rendered)
+        self.assertIn('COPY payload.txt /payload.txt', rendered)
+        self.assertIn('payload content', rendered)
+        self.assertIn('<2 bytes of binary content>', rendered)
+        self.assertIn('docker run --rm -it --network host <image> true', rendered)
+
+    def test_render_does_not_touch_host(self):
+        from rocker.nvidia_extension import X11
+        from rocker.extensions import User
+        cliargs = {'mode': 'render', 'user': True, 'user_mapping': 'runtime', 'x11': True}
+        dig = DockerImageGenerator([User(), X11()], cliargs, 'ubuntu:bionic')
+        output = io.StringIO()
+        with patch('rocker.nvidia_extension.subprocess.check_call') as mock_call, \
+                patch('rocker.extensions.tempfile.mkdtemp') as mock_mkdtemp, \
+                patch('rocker.extensions.tempfile.TemporaryDirectory') as mock_tempdir, \
+                patch('rocker.core.get_docker_client') as mock_client:
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(dig.render('true', mode='render'), 0)
+            mock_call.assert_not_called()
+            mock_mkdtemp.assert_not_called()
+            mock_tempdir.assert_not_called()
+            mock_client.assert_not_called()
+        rendered = output.getvalue()
+        self.assertIn('-v <user mapping directory>:/etc/rocker/user:ro', rendered)
+        self.assertIn('XAUTHORITY=<xauth file>', rendered)
+
+    def test_hook_memoization(self):
+        class CountingExtension(RockerExtension):
+            calls = 0
+
+            @classmethod
+            def get_name(cls):
+                return 'counting'
+
+            def get_snippet(self, cli_args):
+                CountingExtension.calls += 1
+                return 'RUN echo %s' % cli_args.get('value')
+
+        class UncachedExtension(CountingExtension):
+            memoize_hooks = False
+
+        extension = CountingExtension()
+        for _ in range(3):
+            dig = DockerImageGenerator([extension], {'value': 1}, 'ubuntu:bionic')
+            self.assertIn('RUN echo 1', dig.dockerfile)
+        self.assertEqual(CountingExtension.calls, 1)
+        self.assertIn('RUN echo 2', call_extension_hook(extension, 'get_snippet', {'value': 2, 'base_image': 'ubuntu:bionic'}))
+        self.assertEqual(CountingExtension.calls, 2)
+
+        CountingExtension.calls = 0
+        extension = UncachedExtension()
+        for _ in range(3):
+            DockerImageGenerator([extension], {'value': 1}, 'ubuntu:bionic')
+        self.assertEqual(CountingExtension.calls, 3)
+
+        class PreconditionExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'precondition'
+
+            runs = 0
+
+            def precondition_environment(self, cli_args):
+                self.runs += 1
+                self.path = '/tmp/precondition_%d' % self.runs
+
+            def get_docker_args(self, cli_args):
+                return ' -v %s:/data' % self.path
+
+        # Docker arguments depending on the precondition are not reused
+        extension = PreconditionExtension()
+        args = []
+        for _ in range(2):
+            extension.precondition_environment({})
+            args.append(call_extension_hook(extension, 'get_docker_args', {}))
+        self.assertNotEqual(args[0], args[1])
+
+    def test_aggregated_apt_packages(self):
+        class FirstAptExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'first_apt'
+
+            def get_apt_packages(self, cli_args):
+                return ['sudo', 'emacs']
+
+        class SecondAptExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'second_apt'
+
+            def get_apt_packages(self, cli_args):
+                return ['byobu', 'sudo']
+
+            def get_snippet(self, cli_args):
+                return 'RUN byobu --version'
+
+        dig = DockerImageGenerator([FirstAptExtension(), SecondAptExtension()], {}, 'ubuntu:bionic')
+        self.assertEqual(dig.dockerfile.count('apt-get update'), 1)
+        self.assertIn('# Apt packages from extensions [first_apt, second_apt]', dig.dockerfile)
+        self.assertIn('for package in byobu emacs sudo; do', dig.dockerfile)
+        self.assertLess(dig.dockerfile.index('apt-get update'), dig.dockerfile.index('RUN byobu --version'))
+        self.assertLess(dig.dockerfile.index('USER root'), dig.dockerfile.index('apt-get update'))
+        self.assertTrue(dig.requires_build())
+
+        dig = DockerImageGenerator([], {}, 'ubuntu:bionic')
+        self.assertNotIn('apt-get', dig.dockerfile)
+
+    def test_lazy_extension(self):
+        from rocker.ulimit_extension import Ulimit
+
+        class FakeEntryPoint:
+            name = 'ulimit'
+            value = 'rocker.ulimit_extension:Ulimit'
+
+            def __init__(self):
+                self.load_count = 0
+
+            def load(self):
+                self.load_count += 1
+                return Ulimit
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}):
+                with patch('rocker.core._plugin_metadata', None):
+                    entry_point = FakeEntryPoint()
+                    lazy = LazyExtension(entry_point)
+                    lazy.register_arguments(argparse.ArgumentParser(), {})
+                    self.assertEqual(entry_point.load_count, 1)
+
+                with patch('rocker.core._plugin_metadata', None):
+                    # A new process reads the metadata from disk and does not import the extension
+                    entry_point = FakeEntryPoint()
+                    lazy = LazyExtension(entry_point)
+                    parser = argparse.ArgumentParser()
+                    lazy.register_arguments(parser, {})
+                    self.assertEqual(lazy.get_name(), 'ulimit')
+                    cli_args = vars(parser.parse_args(['--ulimit', 'nofile=1024']))
+                    self.assertTrue(lazy.check_args_for_activation(cli_args))
+                    self.assertFalse(lazy.check_args_for_activation({}))
+                    self.assertEqual(entry_point.load_count, 0)
+
+                    extension = lazy()
+                    self.assertIsInstance(extension, Ulimit)
+                    self.assertEqual(entry_point.load_count, 1)
+
+                # The cache is plain json, the str type of the ulimit argument is stored by name
+                with open(os.path.join(cache_dir, 'rocker', 'plugin_metadata.json')) as fh:
+                    stored = json.load(fh)
+                [metadata] = stored.values()
+                self.assertEqual(metadata['arguments'][0][1]['type'], 'str')
+
+                with patch('rocker.core._plugin_metadata', None):
+                    # Arguments with custom type callables are not cached
+                    from rocker.constraint_extensions import CpuLimits
+                    entry_point = FakeEntryPoint()
+                    entry_point.name = 'cpu_limits'
+                    entry_point.value = 'rocker.constraint_extensions:CpuLimits'
+                    entry_point.load = lambda: CpuLimits
+                    lazy = LazyExtension(entry_point)
+                    lazy.register_arguments(argparse.ArgumentParser(), {})
+                    self.assertIsNone(lazy.metadata)
+
+                with patch('rocker.core._plugin_metadata', None):
+                    # Metadata recorded for an older version of a module is replaced
+                    with patch('os.path.getmtime', return_value=0.0):
+                        entry_point = FakeEntryPoint()
+                        LazyExtension(entry_point).register_arguments(argparse.ArgumentParser(), {})
+                    with open(os.path.join(cache_dir, 'rocker', 'plugin_metadata.json')) as fh:
+                        keys = [json.loads(k) for k in json.load(fh)]
+                    self.assertEqual([k[3] for k in keys if k[0] == 'ulimit'], [0.0])
+                    self.assertEqual(len(keys), 1)
+
+                with patch('rocker.core._plugin_metadata', None), \
+                        patch('rocker.core.PLUGIN_METADATA_CACHE_SIZE', 2):
+                    for mtime in range(3):
+                        rocker.core._store_plugin_metadata(
+                            json.dumps(['ext%d' % mtime, 'mod:Ext', '/mod.py', mtime, '/home']), {})
+                    with open(os.path.join(cache_dir, 'rocker', 'plugin_metadata.json')) as fh:
+                        keys = [json.loads(k) for k in json.load(fh)]
+                    self.assertEqual([k[0] for k in keys], ['ext1', 'ext2'])
+
+    def test_entry_point_index(self):
+        real_scan = rocker.core._scan_entry_points
+        with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as site_dir:
+            with patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}), \
+                    patch.object(sys, 'path', sys.path + [site_dir]), \
+                    patch('rocker.core._scan_entry_points', side_effect=real_scan) as scan:
+                try:
+                    clear_entry_point_index()
+                    names = [e.name for e in get_entry_points('rocker.extensions')]
+                    self.assertIn('user', names)
+                    plugins = list_plugins()
+                    self.assertIs(RockerExtensionManager().available_plugins['user'], plugins['user'])
+                    self.assertEqual(scan.call_count, 1)
+
+                    # Another process reads the index from disk
+                    clear_entry_point_index()
+                    self.assertEqual([e.name for e in get_entry_points('rocker.extensions')], names)
+                    self.assertEqual(scan.call_count, 1)
+                    self.assertIsInstance(list_plugins()['user'](), rocker.extensions.User)
+
+                    # Installing a distribution invalidates the index
+                    clear_entry_point_index()
+                    dist_info = os.path.join(site_dir, 'example-1.0.dist-info')
+                    os.mkdir(dist_info)
+                    get_entry_points('rocker.extensions')
+                    self.assertEqual(scan.call_count, 2)
+
+                    # So does rewriting the entry points of a development install in place
+                    entry_points_file = os.path.join(dist_info, 'entry_points.txt')
+                    with open(entry_points_file, 'w') as fh:
+                        fh.write('[rocker.extensions]\n')
+                    clear_entry_point_index()
+                    get_entry_points('rocker.extensions')
+                    self.assertEqual(scan.call_count, 3)
+                    with open(entry_points_file, 'a') as fh:
+                        fh.write('example = example:Example\n')
+                    os.utime(entry_points_file, ns=(0, 0))
+                    clear_entry_point_index()
+                    get_entry_points('rocker.extensions')
+                    self.assertEqual(scan.call_count, 4)
+                finally:
+                    clear_entry_point_index()
+
+    def test_manifest(self):
+        class ArgsExtension(RockerExtension):
+            calls = 0
+
+            @classmethod
+            def get_name(cls):
+                return 'args_extension'
+
+            def get_snippet(self, cli_args):
+                return 'RUN true'
+
+            def get_docker_args(self, cli_args):
+                ArgsExtension.calls += 1
+                return ' --network host'
+
+        dig = DockerImageGenerator([ArgsExtension()], {'mode': 'non-interactive'}, 'ubuntu:jammy')
+        dig.built = True
+        dig.image_id = 'sha256:abc'
+        dig.config_hash = 'abcdef'
+        manifest = dig.get_manifest('rocker-cache:abcdef', 'echo built')
+        self.assertEqual(manifest['docker_args'], ' --network host')
+        self.assertEqual(manifest['mode'], 'non-interactive')
+
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'manifest.json')
+            write_manifest(manifest, path)
+            self.assertEqual(load_manifest(path), manifest)
+            with open(path, 'w') as fh:
+                fh.write('{"manifest_version": 0}')
+            with self.assertRaises(ValueError):
+                load_manifest(path)
+
+        calls = ArgsExtension.calls
+        with patch('rocker.core.record_image_usage') as mock_usage, \
+                patch('rocker.core.subprocess.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(run_manifest(manifest, mode='non-interactive'), 0)
+            self.assertEqual(mock_run.call_args[0][0],
+                ['docker', 'run', '--rm', '--network', 'host', 'rocker-cache:abcdef', 'echo', 'built'])
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_manifest(manifest, 'echo other', mode='non-interactive', nocleanup=True)
+            self.assertEqual(mock_run.call_args[0][0][-5:], ['--network', 'host', 'rocker-cache:abcdef', 'echo', 'other'])
+            self.assertNotIn('--rm', mock_run.call_args[0][0])
+            mock_usage.assert_called_with('sha256:abc', 'abcdef')
+        # Running from the manifest does not invoke the extensions
+        self.assertEqual(ArgsExtension.calls, calls)
+        self.assertEqual(dig.generate_docker_cmd('echo', mode='non-interactive'),
+            'docker run --rm --network host sha256:abc echo')
+
+    def test_run_with_parsed_arguments(self):
+        from rocker.cli import create_parser
+        parser, _ = create_parser('test')
+        # cli.main passes all parsed arguments, including the image positional
+        args_dict = vars(parser.parse_args(['--mode', 'dry-run', '--network', 'host', 'ubuntu:jammy', 'echo', 'hi']))
+        args_dict['command'] = ' '.join(args_dict['command'])
+        extensions = [list_plugins()['network']()]
+        dig = DockerImageGenerator(extensions, args_dict, 'ubuntu:jammy')
+        dig.built = True
+        dig.image_id = 'sha256:abc'
+        self.assertEqual(dig.generate_docker_cmd(**args_dict).split(),
+            'docker run --rm -it --network host sha256:abc echo hi'.split())
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(dig.run(**args_dict), 0)
+            self.assertEqual(dig.render(**dict(args_dict, mode='render')), 0)
+        rendered = ' '.join(output.getvalue().split())
+        self.assertIn('docker run --rm -it --network host sha256:abc echo hi', rendered)
+        self.assertIn('docker run --rm -it --network host <image> echo hi', rendered)
+
+    def test_shared_docker_client(self):
+        fake_client = object()
+        try:
+            set_docker_client(fake_client)
+            self.assertIs(get_docker_client(), fake_client)
+            self.assertIs(get_docker_client(), fake_client)
+            set_docker_client(None)
+            with patch('rocker.core.create_docker_client', return_value='new_client') as mock_create:
+                self.assertEqual(get_docker_client(), 'new_client')
+                self.assertEqual(get_docker_client(), 'new_client')
+                self.assertEqual(mock_create.call_count, 1)
+        finally:
+            set_docker_client(None)
+
+    def test_daemon_info_cache(self):
+        class FakeDockerClient:
+            base_url = 'http+docker://localhost'
+
+            def __init__(self):
+                self.calls = 0
+
+            def version(self):
+                self.calls += 1
+                return {'Version': '24.0.7', 'ApiVersion': '1.43'}
+
+            def info(self):
+                return {'Runtimes': {'runc': {}, 'nvidia': {}}, 'Driver': 'overlay2'}
+
+        fake_client = FakeDockerClient()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}):
+                with patch('rocker.core._daemon_info', {}):
+                    info = get_daemon_info(fake_client)
+                    self.assertEqual(info['version'], '24.0.7')
+                    self.assertEqual(info['api_version'], '1.43')
+                    self.assertEqual(info['runtimes'], ['nvidia', 'runc'])
+                    self.assertEqual(info['storage_driver'], 'overlay2')
+                    get_daemon_info(fake_client)
+                    self.assertEqual(fake_client.calls, 1)
+                with patch('rocker.core._daemon_info', {}):
+                    # Another process reads from disk unless the entry expired
+                    get_daemon_info(fake_client)
+                    self.assertEqual(fake_client.calls, 1)
+                    get_daemon_info(fake_client, ttl=0)
+                    self.assertEqual(fake_client.calls, 2)
+
+    def test_build_streams_context(self):
+        class SnippetExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'snippet_extension'
+
+            def get_snippet(self, cli_args):
+                return 'RUN true'
+
+        class FakeDockerClient:
+            base_url = 'https://remote-host:2376'
+
+            def inspect_image(self, image):
+                return {'Id': 'sha256:base'}
+
+        dig = DockerImageGenerator([SnippetExtension()], {}, 'ubuntu:bionic')
+        with patch('rocker.core.get_docker_client', return_value=FakeDockerClient()), \
+                patch('rocker.core.record_image_usage') as mock_usage:
+            with patch('rocker.core.docker_build', return_value='abc123') as mock_build:
+                self.assertEqual(dig.build(), 0)
+        build_kwargs = mock_build.call_args[1]
+        self.assertTrue(build_kwargs['custom_context'])
+        self.assertEqual(build_kwargs['encoding'], 'gzip')
+        self.assertNotIn('path', build_kwargs)
+        self.assertEqual(dig.image_id, 'abc123')
+        self.assertEqual(build_kwargs['labels']['rocker.config_hash'], dig.config_hash)
+        self.assertIn('rocker.built_at', build_kwargs['labels'])
+        # Images which are not kept are not tracked for `rocker gc`
+        mock_usage.assert_not_called()
+
+        with patch('rocker.core.record_image_usage') as mock_usage, \
+                patch('rocker.core.subprocess.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(dig.run('true', mode='non-interactive'), 0)
+                mock_usage.assert_not_called()
+                self.assertEqual(dig.run('true', mode='non-interactive', persist_image=True), 0)
+            mock_usage.assert_called_once_with('abc123', dig.config_hash)
+
+        with patch('rocker.core.docker_remove_image', return_value=True), \
+                patch('rocker.core.forget_image_usage') as mock_forget:
+            dig.clear_image()
+        mock_forget.assert_called_once_with(['abc123'])
+
+    def test_buildx_build(self):
+        class FakePopen:
+            def __init__(self, cmd, stdin=None, stdout=None, stderr=None):
+                FakePopen.cmd = cmd
+                self.stdin = io.BytesIO()
+                self.stdin.close = lambda: None
+                FakePopen.stdin_data = self.stdin
+                self.stdout = [b'#1 [internal] load build definition\n', b'#2 DONE\n']
+                self.returncode = 0
+                with open(cmd[cmd.index('--iidfile') + 1], 'w') as fh:
+                    fh.write('sha256:abcdef\n')
+
+            def wait(self):
+                return self.returncode
+
+        outputs = []
+        with patch('rocker.core.subprocess.Popen', FakePopen):
+            image_id = docker_buildx_build(
+                fileobj=io.BytesIO(b'context'), tag='foo:bar', nocache=True, buildargs={'A': '1'},
+                labels={'rocker.config_hash': 'abc'},
+                rm=True, output_callback=outputs.append)
+        self.assertEqual(image_id, 'sha256:abcdef')
+        self.assertEqual(FakePopen.cmd[:3], ['docker', 'buildx', 'build'])
+        self.assertIn('--no-cache', FakePopen.cmd)
+        self.assertIn('A=1', FakePopen.cmd)
+        self.assertEqual(FakePopen.cmd[FakePopen.cmd.index('--label') + 1], 'rocker.config_hash=abc')
+        self.assertEqual(FakePopen.cmd[-1], '-')
+        self.assertEqual(FakePopen.cmd[FakePopen.cmd.index('--tag') + 1], 'foo:bar')
+        self.assertEqual(FakePopen.stdin_data.getvalue(), b'context')
+        self.assertEqual(outputs, ['#1 [internal] load build definition', '#2 DONE'])
@@ -0,0 +1,146 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import subprocess
+import unittest
+
+from rocker.core import generate_dockerfile
+from rocker.dockerfile import Instruction
+from rocker.dockerfile import deduplicate_args
+from rocker.dockerfile import deduplicate_copy_from
+from rocker.dockerfile import hoist_volatile
+from rocker.dockerfile import merge_envs
+from rocker.dockerfile import merge_runs
+from rocker.dockerfile import optimize
+from rocker.dockerfile import parse_dockerfile
+from rocker.dockerfile import render_dockerfile
+from rocker.extensions import RockerExtension
+
+
+class DockerfileParserTest(unittest.TestCase):
+
+    def test_parse(self):
+        instructions = parse_dockerfile("""# a comment
+run apt-get update \\
+# dropped comment inside a continuation
+    && apt-get install -y sudo
+
+ENV A=1
+RUN <<EOF
+echo heredoc
+EOF
+# trailing comment
+""")
+        self.assertEqual([i.keyword for i in instructions], ['RUN', 'ENV', 'RUN', ''])
+        self.assertEqual(instructions[0].comments, ['# a comment'])
+        self.assertEqual(instructions[0].arguments, 'apt-get update \\\n    && apt-get install -y sudo')
+        self.assertFalse(instructions[0].heredoc)
+        self.assertTrue(instructions[2].heredoc)
+        self.assertEqual(instructions[2].arguments, '<<EOF\necho heredoc\nEOF')
+        self.assertEqual(instructions[3].comments, ['# trailing comment'])
+
+    def test_render_roundtrip(self):
+        text = 'FROM ubuntu:jammy\n\n# install\nRUN true \\\n && false\n'
+        self.assertEqual(render_dockerfile(parse_dockerfile(text)), text)
+
+
+class DockerfileOptimizerTest(unittest.TestCase):
+
+    def test_merge_runs(self):
+        instructions = parse_dockerfile(
+            'RUN cd /tmp\n'
+            'RUN pwd\n'
+            'RUN ["echo", "exec"]\n'
+            'RUN --mount=type=cache,target=/a true\n'
+            'RUN a\n'
+            'RUN b # comment\n'
+            'RUN c\n')
+        merged = merge_runs(instructions)
+        self.assertEqual([i.arguments for i in merged], [
+            '( cd /tmp ) \\\n && ( pwd )',
+            '["echo", "exec"]',
+            '--mount=type=cache,target=/a true',
+            'a',
+            'b # comment',
+            'c'])
+        # Changing directory does not leak into the following command
+        script = merged[0].arguments.replace('\\\n', '')
+        self.assertNotEqual(subprocess.check_output(['sh', '-c', script], cwd='/').strip(), b'/tmp')
+
+    def test_merge_runs_volatility(self):
+        instructions = [Instruction('RUN', 'a'), Instruction('RUN', 'b', volatile=True)]
+        self.assertEqual(merge_runs(instructions), instructions)
+
+    def test_merge_envs(self):
+        instructions = parse_dockerfile('ENV A 1\nENV B=2 C="x y"\nENV D ${A}\nENV E "quoted"\n')
+        merged = merge_envs(instructions)
+        self.assertEqual([i.arguments for i in merged], [
+            'A="1" \\\n    B=2 C="x y"',
+            'D ${A}',
+            'E "quoted"'])
+
+    def test_deduplicate(self):
+        instructions = parse_dockerfile(
+            'ARG DEBIAN_FRONTEND=noninteractive\n'
+            'FROM glvnd AS glvnd\n'
+            'FROM ubuntu\n'
+            'ARG DEBIAN_FRONTEND=noninteractive\n'
+            'COPY --from=glvnd /a /a\n'
+            '# second copy\n'
+            'ARG  DEBIAN_FRONTEND=noninteractive\n'
+            'COPY --from=glvnd /a /a\n'
+            'RUN true\n')
+        optimized = deduplicate_copy_from(deduplicate_args(instructions))
+        self.assertEqual([i.keyword for i in optimized], ['ARG', 'FROM', 'FROM', 'ARG', 'COPY', 'RUN'])
+        self.assertEqual(optimized[-1].comments, ['# second copy'])
+
+    def test_hoist_volatile(self):
+        instructions = [
+            Instruction('RUN', 'volatile', volatile=True),
+            Instruction('RUN', 'stable'),
+            Instruction('USER', 'me'),
+            Instruction('RUN', 'after user'),
+        ]
+        self.assertEqual([i.arguments for i in hoist_volatile(instructions)],
+            ['stable', 'volatile', 'me', 'after user'])
+
+    def test_optimize_does_not_mutate(self):
+        instructions = parse_dockerfile('RUN a\nRUN b\nENV A=1\nENV B=2\n')
+        copies = [i.copy() for i in instructions]
+        self.assertEqual(len(optimize(instructions)), 2)
+        self.assertEqual(instructions, copies)
+
+    def test_generate_dockerfile(self):
+        class InstructionExtension(RockerExtension):
+            @classmethod
+            def get_name(cls):
+                return 'instructions'
+
+            def get_snippet(self, cliargs):
+                return [Instruction('RUN', 'echo one'), Instruction('RUN', 'echo two')]
+
+            def get_user_snippet(self, cliargs):
+                return 'RUN echo three\nRUN echo four\n'
+
+        dockerfile = generate_dockerfile([InstructionExtension()], {}, 'ubuntu:jammy')
+        self.assertIn('RUN echo one\nRUN echo two\n', dockerfile)
+        self.assertIn('RUN echo three\nRUN echo four\n', dockerfile)
+
+        dockerfile = generate_dockerfile([InstructionExtension()], {'optimize_dockerfile': True}, 'ubuntu:jammy')
+        self.assertIn('RUN ( echo one ) \\\n && ( echo two ) \\\n && ( echo three ) \\\n && ( echo four )\n', dockerfile)
+        self.assertIn('# Snippet from extension [instructions]', dockerfile)
+        self.assertIn('FROM ubuntu:jammy', dockerfile)
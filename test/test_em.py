@@ -0,0 +1,97 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import em
+import time
+import unittest
+from unittest.mock import patch
+
+from rocker.em import clear_template_caches
+from rocker.em import empy_expand
+from rocker.em import expand_template
+from rocker.em import get_template
+
+TEMPLATE = 'templates/user_snippet.Dockerfile.em'
+SUBSTITUTIONS = {
+    'name': 'rocker', 'uid': 1000, 'gid': 1000, 'gecos': 'Rocker', 'dir': '/home/rocker', 'shell': '/bin/bash',
+    'user_preserve_home': False, 'user_groups': 'video;44', 'user_preserve_groups_permissive': False,
+    'home_extension_active': False, 'user_ownership_fix': 'bounded', 'ownership_fix_paths': ['/home', '/opt'],
+}
+
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Work around interference between empy Interpreter
+        # stdout proxy and test runner. empy installs a proxy on stdout
+        # to be able to capture the information.
+        # And the test runner creates a new stdout object for each test.
+        # This breaks empy as it assumes that the proxy has persistent
+        # between instances of the Interpreter class
+        # empy will error with the exception
+        # "em.Error: interpreter stdout proxy lost"
+        em.Interpreter._wasProxyInstalled = False
+        clear_template_caches()
+
+    def tearDown(self):
+        clear_template_caches()
+
+    def test_template_cache(self):
+        expected = expand_template('rocker', TEMPLATE, SUBSTITUTIONS)
+        self.assertIn('useradd', expected)
+        with patch('rocker.em.pkgutil.get_data') as get_data, patch('em.expand') as expand:
+            self.assertEqual(expand_template('rocker', TEMPLATE, SUBSTITUTIONS), expected)
+            get_data.assert_not_called()
+            expand.assert_not_called()
+        self.assertEqual(get_template.cache_info().misses, 1)
+
+        # Different substitutions are expanded again
+        self.assertIn('-s /bin/zsh', expand_template('rocker', TEMPLATE, dict(SUBSTITUTIONS, shell='/bin/zsh')))
+
+    def test_uncacheable_substitutions(self):
+        class Value(object):
+            def __str__(self):
+                return 'value'
+
+        with patch('rocker.em._empy_expand', return_value='value') as expand:
+            empy_expand('@(v)', {'v': Value()})
+            empy_expand('@(v)', {'v': Value()})
+            self.assertEqual(expand.call_count, 2)
+
+    def test_equal_values_of_different_types(self):
+        self.assertEqual(empy_expand('@(x)', {'x': 1}), '1')
+        self.assertEqual(empy_expand('@(x)', {'x': True}), 'True')
+        self.assertEqual(empy_expand('@(x)', {'x': 1.0}), '1.0')
+        self.assertEqual(empy_expand('@(x)', {'x': [0]}), '[0]')
+        self.assertEqual(empy_expand('@(x)', {'x': [False]}), '[False]')
+
+    def test_benchmark(self):
+        iterations = 20
+        start = time.perf_counter()
+        for _ in range(iterations):
+            clear_template_caches()
+            expand_template('rocker', TEMPLATE, SUBSTITUTIONS)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            expand_template('rocker', TEMPLATE, SUBSTITUTIONS)
+        warm = time.perf_counter() - start
+
+        print('Template expansion cold %.2fms warm %.3fms per call' % (
+            cold / iterations * 1000, warm / iterations * 1000))
+        self.assertLess(warm * 10, cold)
@@ -23,6 +23,8 @@ import unittest
 from pathlib import Path
 import pwd
 import pytest
+import subprocess
+import tempfile
 from io import BytesIO as StringIO
 import grp
 from unittest.mock import patch
@@ -31,6 +33,9 @@ from unittest.mock import patch
 from rocker.core import DockerImageGenerator
 from rocker.core import docker_build
 from rocker.core import list_plugins
+from rocker.extensions import get_group_by_gid
+from rocker.extensions import get_group_by_name
+from rocker.extensions import get_supplementary_groups
 from rocker.extensions import name_to_argument
 
 
@@ -216,6 +221,24 @@ class NetworkExtensionTest(unittest.TestCase):
         args = p.get_docker_args(mock_cliargs)
         self.assertTrue('--network host' in args)
 
+    def test_network_validation(self):
+        plugins = list_plugins()
+        p = plugins['network']()
+        parser = argparse.ArgumentParser()
+        with patch('rocker.extensions._docker_networks', None):
+            with patch('rocker.extensions.get_docker_client') as mock_client:
+                mock_client.return_value.networks.return_value = [{'Name': 'bridge'}, {'Name': 'host'}]
+                # Not querying the daemon unless a network is requested
+                p.validate_environment({'network': None}, parser)
+                mock_client.assert_not_called()
+
+                p.validate_environment({'network': 'host'}, parser)
+                p.validate_environment({'network': 'bridge'}, parser)
+                self.assertEqual(mock_client.return_value.networks.call_count, 1)
+                with patch.object(parser, 'error', side_effect=SystemExit) as mock_error:
+                    self.assertRaises(SystemExit, p.validate_environment, {'network': 'missing'}, parser)
+                    self.assertIn("invalid choice: 'missing'", mock_error.call_args[0][0])
+
 class ExposeExtensionTest(unittest.TestCase):
 
     def setUp(self):
@@ -374,6 +397,12 @@ class PrivilegedExtensionTest(unittest.TestCase):
         self.assertTrue('--privileged' in args)
 
 
+def clear_group_caches():
+    get_group_by_gid.cache_clear()
+    get_group_by_name.cache_clear()
+    get_supplementary_groups.cache_clear()
+
+
 class UserExtensionTest(unittest.TestCase):
 
     def setUp(self):
@@ -421,13 +450,15 @@ class UserExtensionTest(unittest.TestCase):
         user_override_active_cliargs = mock_cliargs
         user_override_active_cliargs['user_preserve_groups'] = []
         mock_group_with_user = grp.struct_group(('testgroup', 'x', 1234, [env_subs['name']]))
-        with patch('rocker.extensions.grp.getgrall', return_value=[mock_group_with_user]):
+        clear_group_caches()
+        with patch('rocker.extensions.os.getgrouplist', return_value=[os.getgid(), 1234]), \
+                patch('rocker.extensions.grp.getgrgid', return_value=mock_group_with_user):
             snippet_result = p.get_snippet(user_override_active_cliargs)
             self.assertTrue('usermod -aG' in snippet_result)
 
         # Test user_preserve_groups with mocked groups (user is NOT a member)
-        mock_group_without_user = grp.struct_group(('othergroup', 'x', 5678, ['someotheruser']))
-        with patch('rocker.extensions.grp.getgrall', return_value=[mock_group_without_user]):
+        clear_group_caches()
+        with patch('rocker.extensions.os.getgrouplist', return_value=[os.getgid()]):
             snippet_result = p.get_snippet(user_override_active_cliargs)
             self.assertFalse('usermod -aG' in snippet_result)
 
@@ -438,7 +469,8 @@ class UserExtensionTest(unittest.TestCase):
             grp.struct_group(('cdrom', 'x', 24, [])),
             grp.struct_group(('audio', 'x', 29, [])),
         ]
-        with patch('rocker.extensions.grp.getgrall', return_value=mock_explicit_groups):
+        clear_group_caches()
+        with patch('rocker.extensions.grp.getgrnam', side_effect={g.gr_name: g for g in mock_explicit_groups}.__getitem__):
             snippet_result = p.get_snippet(user_override_active_cliargs)
             self.assertTrue('cdrom' in snippet_result)
             self.assertTrue('audio' in snippet_result)
@@ -447,13 +479,16 @@ class UserExtensionTest(unittest.TestCase):
         user_override_active_cliargs = mock_cliargs
         user_override_active_cliargs['user_preserve_groups'] = []
         user_override_active_cliargs['user_preserve_groups_permissive'] = True
-        with patch('rocker.extensions.grp.getgrall', return_value=[mock_group_with_user]):
+        clear_group_caches()
+        with patch('rocker.extensions.os.getgrouplist', return_value=[os.getgid(), 1234]), \
+                patch('rocker.extensions.grp.getgrgid', return_value=mock_group_with_user):
             snippet_result = p.get_snippet(user_override_active_cliargs)
             self.assertTrue('usermod -aG' in snippet_result)
             self.assertTrue('user-preserve-group-permissive Enabled' in snippet_result)
 
         # Test permissive mode with mocked groups (user is NOT a member)
-        with patch('rocker.extensions.grp.getgrall', return_value=[mock_group_without_user]):
+        clear_group_caches()
+        with patch('rocker.extensions.os.getgrouplist', return_value=[os.getgid()]):
             snippet_result = p.get_snippet(user_override_active_cliargs)
             self.assertFalse('usermod -aG' in snippet_result)
             self.assertFalse('user-preserve-group-permissive Enabled' in snippet_result)
@@ -478,6 +513,118 @@ class UserExtensionTest(unittest.TestCase):
         snippet_result = p.get_snippet(user_override_active_cliargs)
         self.assertFalse('-s' in snippet_result)
 
+    def test_user_groups_lookup(self):
+        p = list_plugins()['user']()
+        clear_group_caches()
+        group = grp.struct_group(('video', 'x', 44, []))
+        with patch('rocker.extensions.grp.getgrall') as getgrall, \
+                patch('rocker.extensions.os.getgrouplist', return_value=[os.getgid(), 44, 44]) as getgrouplist, \
+                patch('rocker.extensions.grp.getgrgid', return_value=group) as getgrgid:
+            substitutions = p.get_user_substitutions({'user_preserve_groups': []})
+            self.assertEqual(substitutions['user_groups'], 'video;44')
+            p.get_user_substitutions({'user_preserve_groups': []})
+            getgrall.assert_not_called()
+            getgrouplist.assert_called_once()
+            getgrgid.assert_called_once_with(44)
+        clear_group_caches()
+
+    def test_user_ownership_fix(self):
+        p = list_plugins()['user']()
+        cliargs = {'user': True, 'user_override_name': 'ubuntu'}
+        snippet = p.get_snippet(cliargs)
+        self.assertIn('for search_path in "${existing_user_home}" /home /opt /srv /tmp /usr/local /var; do', snippet)
+        self.assertIn('-xdev \\( -path /proc -o -path /sys \\) -prune', snippet)
+        self.assertNotIn('find / ', snippet)
+
+        cliargs['user_ownership_fix'] = 'full'
+        snippet = p.get_snippet(cliargs)
+        self.assertIn('search_paths=/;', snippet)
+        self.assertNotIn('existing_user_home', snippet)
+
+        cliargs['user_ownership_fix'] = 'none'
+        snippet = p.get_snippet(cliargs)
+        self.assertNotIn('find ', snippet)
+        self.assertIn('userdel', snippet)
+
+    def test_user_runtime_mapping(self):
+        p = list_plugins()['user']()
+        cliargs = {'user': True, 'user_mapping': 'runtime', 'base_image': 'ubuntu:jammy',
+                   'user_override_name': 'rockeruser', 'user_override_shell': ''}
+
+        with patch('rocker.extensions.get_image_config',
+                   return_value={'Entrypoint': ['/ros_entrypoint.sh'], 'Cmd': ['bash']}) as get_config:
+            snippet = p.get_snippet(cliargs)
+            get_config.assert_called_once_with('ubuntu:jammy')
+        # Nothing specific to the invoking user ends up in the image
+        self.assertNotIn('rockeruser', snippet)
+        self.assertNotIn('useradd', snippet)
+        self.assertIn('COPY rocker_user_entrypoint.sh /usr/local/bin/rocker-user-entrypoint', snippet)
+        self.assertIn('ENTRYPOINT ["/usr/local/bin/rocker-user-entrypoint", "/ros_entrypoint.sh"]', snippet)
+        self.assertIn('CMD ["bash"]', snippet)
+        self.assertIn('rocker_user_entrypoint.sh', p.get_files(cliargs))
+        self.assertEqual(p.get_files({'user': True}), {})
+
+        self.assertNotIn('Rendered without the docker daemon', snippet)
+
+        dig = DockerImageGenerator([p], dict(cliargs, mode='render'), 'ubuntu:jammy')
+        self.assertNotIn('USER rockeruser', dig.dockerfile)
+        # The chaining of the base image entrypoint is not silently dropped
+        self.assertIn('the ENTRYPOINT of ubuntu:jammy\n# is appended', dig.dockerfile)
+
+        fragments = p.get_user_fragments(cliargs)
+        self.assertEqual(fragments['passwd'], 'rockeruser:x:%s:%s:%s:/home/rockeruser:\n' % (
+            os.getuid(), os.getgid(), pwd.getpwuid(os.getuid()).pw_gecos))
+        self.assertEqual(fragments['sudoers'], 'rockeruser ALL=NOPASSWD: ALL\n')
+        self.assertTrue(fragments['group'].startswith('rockeruser:x:%s:\n' % os.getgid()))
+
+        args = p.get_docker_args(cliargs)
+        self.assertIn(':/etc/rocker/user:ro', args)
+        mount_source = args.split()[1].split(':')[0]
+        with open(os.path.join(mount_source, 'passwd')) as fh:
+            self.assertEqual(fh.read(), fragments['passwd'])
+        self.assertEqual(p.get_docker_args({'user': True}), '')
+
+    def test_user_runtime_entrypoint_accounts(self):
+        p = list_plugins()['user']()
+        script = p.get_files({'user': True, 'user_mapping': 'runtime'})['rocker_user_entrypoint.sh']
+        # Run only the merging of the account databases on copies
+        start = script.index('# Replace any account')
+        merge = script[start:script.index('if [ -d /etc/sudoers.d ]')]
+        with tempfile.TemporaryDirectory() as td:
+            etc = os.path.join(td, 'etc')
+            user_dir = os.path.join(td, 'user')
+            os.mkdir(etc)
+            os.mkdir(user_dir)
+            files = {
+                os.path.join(etc, 'passwd'):
+                    'root:x:0:0:root:/root:/bin/bash\n'
+                    'firstxlast:x:1001:1001::/home/firstxlast:/bin/sh\n'
+                    'ubuntu:x:1000:1000::/home/ubuntu:/bin/bash\n',
+                os.path.join(etc, 'group'):
+                    'root:x:0:\nvideo:x:44:firstxlast\naudio:x:29:\nubuntu:x:1000:\n',
+                os.path.join(user_dir, 'passwd'): 'first.last:x:1000:1000::/home/first.last:/bin/bash\n',
+                os.path.join(user_dir, 'group'): 'first.last:x:1000:\nvideo:x:44:\naudio:x:29:\ndocker:x:998:\n',
+            }
+            for path, contents in files.items():
+                with open(path, 'w') as fh:
+                    fh.write(contents)
+            merge = merge.replace('/etc/', etc + '/')
+            subprocess.check_call(['sh', '-e', '-c',
+                'user_dir=%s\nIFS=: read -r user_name _ user_uid user_gid _ user_home user_shell < "${user_dir}/passwd"\n%s' % (
+                    user_dir, merge)])
+            with open(os.path.join(etc, 'passwd')) as fh:
+                passwd = fh.read()
+            with open(os.path.join(etc, 'group')) as fh:
+                group = fh.read()
+        # Only the account with the same name or uid is replaced
+        self.assertEqual(passwd,
+            'root:x:0:0:root:/root:/bin/bash\n'
+            'firstxlast:x:1001:1001::/home/firstxlast:/bin/sh\n'
+            'first.last:x:1000:1000::/home/first.last:/bin/bash\n')
+        self.assertEqual(group,
+            'root:x:0:\nvideo:x:44:firstxlast,first.last\naudio:x:29:first.last\n'
+            'ubuntu:x:1000:first.last\ndocker:x:998:first.last\n')
+
     @pytest.mark.docker
     def test_user_collisions(self):
         plugins = list_plugins()
@@ -567,14 +714,6 @@ class PulseExtensionTest(unittest.TestCase):
         self.assertIn('/pulse/native:', docker_args)
         self.assertIn('/pulse/native --group-add', docker_args)
 
-EXPECTED_DEV_HELPERS_SNIPPET = """# workspace development helpers
-RUN apt-get update \\
- && apt-get install -y \\
-    byobu \\
-    emacs \\
- && apt-get clean
-"""
-
 class DevHelpersExtensionTest(unittest.TestCase):
 
     def setUp(self):
@@ -598,8 +737,22 @@ class DevHelpersExtensionTest(unittest.TestCase):
         
         mock_cliargs = {}
 
-        self.assertEqual(p.get_snippet(mock_cliargs), EXPECTED_DEV_HELPERS_SNIPPET)
+        self.assertEqual(p.get_snippet(mock_cliargs), '')
         self.assertEqual(p.get_preamble(mock_cliargs), '')
+        self.assertEqual(p.get_apt_packages(mock_cliargs), ['byobu', 'emacs'])
+
+    def test_dev_helpers_apt_cache(self):
+        p = list_plugins()['dev_helpers']()
+        dig = DockerImageGenerator([p], {'apt_cache': True}, 'ubuntu:jammy')
+        self.assertIn('rm -f /etc/apt/apt.conf.d/docker-clean', dig.dockerfile)
+        self.assertIn('RUN --mount=type=cache,id=rocker-apt-lists-ubuntu_jammy,target=/var/lib/apt/lists', dig.dockerfile)
+        self.assertIn('--mount=type=cache,id=rocker-apt-archives-ubuntu_jammy,target=/var/cache/apt', dig.dockerfile)
+        self.assertNotIn('rm -rf /var/lib/apt/lists/*', dig.dockerfile)
+
+        dig = DockerImageGenerator([p], {}, 'ubuntu:jammy')
+        self.assertNotIn('docker-clean', dig.dockerfile)
+        self.assertNotIn('--mount=type=cache', dig.dockerfile)
+        self.assertIn('rm -rf /var/lib/apt/lists/*', dig.dockerfile)
 
 
 class EnvExtensionTest(unittest.TestCase):
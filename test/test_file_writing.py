@@ -23,8 +23,10 @@ import unittest
 from pathlib import Path
 import pwd
 import shlex
+import tarfile
 from tempfile import TemporaryDirectory
 
+from rocker.core import generate_build_context
 from rocker.core import list_plugins
 from rocker.core import write_files
 from rocker.extensions import name_to_argument
@@ -105,3 +107,17 @@ class FileInjectionExtensionTest(unittest.TestCase):
 
             self.assertFalse(os.path.exists('../outside/path/to/test_file.txt'))
             self.assertFalse(os.path.exists('/absolute.txt'))
+
+    def test_build_context(self):
+        extensions = [TestFileInjection()]
+        mock_cliargs = {'test_key': 'test_value'}
+
+        for compress in (False, True):
+            context = generate_build_context(extensions, mock_cliargs, 'FROM scratch\n', compress=compress)
+            with tarfile.open(fileobj=context, mode='r:gz' if compress else 'r') as tar:
+                self.assertEqual(sorted(tar.getnames()),
+                    ['Dockerfile', 'path/to/test_file.txt', 'test_file.bin', 'test_file.txt'])
+                self.assertEqual(tar.extractfile('Dockerfile').read(), b'FROM scratch\n')
+                content = tar.extractfile('path/to/test_file.txt').read().decode()
+                self.assertIn('quick brown', content)
+                self.assertIn('test_value', content)
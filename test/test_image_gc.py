@@ -0,0 +1,166 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from rocker.cli import retain_repeated_image
+from rocker.core import DockerImageGenerator
+from rocker.core import get_image_usage
+from rocker.core import record_config_usage
+from rocker.core import record_image_usage
+from rocker.image_gc import collect_garbage
+from rocker.image_gc import list_rocker_images
+from rocker.image_gc import parse_age
+from rocker.image_gc import parse_size
+from rocker.image_gc import select_images_to_remove
+
+
+class FakeDockerClient(object):
+    def __init__(self, images, containers=()):
+        self._images = images
+        self._containers = list(containers)
+        self.removed = []
+
+    def images(self, filters=None):
+        return [i for i in self._images if filters['label'] in i['Labels']]
+
+    def containers(self, all=False):
+        return self._containers
+
+    def remove_image(self, image, force=False):
+        self.removed.append(image)
+
+
+def image(image_id, size, built_at, tags=()):
+    return {
+        'Id': 'sha256:%s' % (image_id * 64)[:64],
+        'RepoTags': list(tags) or ['<none>:<none>'],
+        'Size': size,
+        'Created': built_at,
+        'Labels': {'rocker.config_hash': image_id, 'rocker.built_at': str(built_at)},
+    }
+
+
+class ImageGcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env_patch = patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_dir.name})
+        self.env_patch.start()
+
+    def tearDown(self):
+        self.env_patch.stop()
+        self.cache_dir.cleanup()
+
+    def test_parse(self):
+        self.assertEqual(parse_size('500M'), 500 * 1000 ** 2)
+        self.assertEqual(parse_size('1.5g'), 1500 * 1000 ** 2)
+        self.assertEqual(parse_size('1024'), 1024)
+        self.assertEqual(parse_age('12h'), 12 * 3600)
+        self.assertEqual(parse_age('7d'), 7 * 86400)
+        self.assertEqual(parse_age('30'), 30)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_size('lots')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_age('-1d')
+
+    def test_select_images_to_remove(self):
+        images = [
+            {'id': 'a', 'size': 100, 'last_used': 10},
+            {'id': 'b', 'size': 100, 'last_used': 20},
+            {'id': 'c', 'size': 100, 'last_used': 30},
+        ]
+        select = lambda **kwargs: [i['id'] for i in select_images_to_remove(images, **kwargs)]
+        self.assertEqual(select(in_use=set()), [])
+        self.assertEqual(select(in_use=set(), max_age=14, now=35), ['a', 'b'])
+        self.assertEqual(select(in_use=set(), max_size=150), ['a', 'b'])
+        self.assertEqual(select(in_use={'a'}, max_size=150), ['b', 'c'])
+        self.assertEqual(select(in_use={'a'}, max_size=250), ['b'])
+
+    def test_collect_garbage(self):
+        client = FakeDockerClient(
+            [image('a', 100, 10), image('b', 100, 20, ['foo:latest']), image('c', 100, 30)],
+            containers=[{'ImageID': image('b', 0, 0)['Id']}])
+        # Usage recorded with the short id reported by the legacy builder
+        record_image_usage('aaaaaaaaaaaa', 'a')
+        images = list_rocker_images(client)
+        self.assertEqual([i['config_hash'] for i in images], ['b', 'c', 'a'])
+        self.assertEqual(images[0]['tags'], ['foo:latest'])
+        self.assertEqual(images[1]['tags'], [])
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(collect_garbage(max_size=150, dry_run=True, docker_client=client), 0)
+        self.assertEqual(client.removed, [])
+        self.assertIn('Would remove image cccccccccccc', output.getvalue())
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(collect_garbage(max_size=150, docker_client=client), 0)
+        # The image used by a container is kept even though it is least recently used
+        self.assertEqual(client.removed, [image('c', 0, 0)['Id'], image('a', 0, 0)['Id']])
+        self.assertEqual(get_image_usage(), {})
+
+    def test_record_image_usage(self):
+        with patch('rocker.core.time.time', return_value=1000):
+            record_image_usage('sha256:a', 'a')
+        with patch('rocker.core.time.time', return_value=1010), \
+                patch('rocker.core.os.replace') as mock_replace:
+            # A use right after the last one does not rewrite the file
+            record_image_usage('sha256:a', 'a')
+            mock_replace.assert_not_called()
+        with patch('rocker.core.time.time', return_value=2000):
+            record_image_usage('sha256:a', 'a')
+        self.assertEqual(get_image_usage(), {'sha256:a': {'last_used': 2000, 'config_hash': 'a'}})
+
+    def test_record_config_usage(self):
+        self.assertEqual(record_config_usage('a', window=100, now=0), 1)
+        self.assertEqual(record_config_usage('b', window=100, now=10), 1)
+        self.assertEqual(record_config_usage('a', window=100, now=50), 2)
+        # The first use of a fell out of the window
+        self.assertEqual(record_config_usage('a', window=100, now=120), 2)
+        self.assertEqual(record_config_usage('b', window=100, now=200), 1)
+
+    def test_retain_repeated_image(self):
+        class FakeTagClient(object):
+            def __init__(self):
+                self.tagged = []
+
+            def tag(self, image, repository, tag=None):
+                self.tagged.append((image, repository, tag))
+
+        client = FakeTagClient()
+        args = {'retain_repeated': 2, 'retain_window': 3600}
+        with patch('rocker.core.get_docker_client', return_value=client), \
+                contextlib.redirect_stdout(io.StringIO()):
+            for run in range(2):
+                dig = DockerImageGenerator([], {}, 'ubuntu:jammy')
+                dig.built = True
+                dig.image_id = 'sha256:run%d' % run
+                dig.config_hash = 'abcdef'
+                retain_repeated_image(dig, args)
+                with patch('rocker.core.docker_remove_image', return_value=True) as mock_remove:
+                    dig.clear_image()
+                # One-off images are removed, the repeated configuration is kept
+                self.assertEqual(mock_remove.called, run == 0)
+        self.assertEqual(client.tagged, [('sha256:run1', 'rocker-cache', 'abcdef')])
+        # Only the usage of the kept image is tracked
+        self.assertEqual(list(get_image_usage()), ['sha256:run1'])
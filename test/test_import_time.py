@@ -0,0 +1,57 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import subprocess
+import sys
+import unittest
+
+# Generous budget in seconds, importing the docker API alone exceeds it on most machines
+IMPORT_TIME_BUDGET = 0.5
+
+# Modules which must only be imported on first use
+DEFERRED_MODULES = ['docker', 'em', 'packaging', 'pexpect', 'requests', 'termios']
+
+MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_import(module):
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT % module])
+    return json.loads(output.decode())
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    def check_import(self, module):
+        # Take the best of several runs to reduce noise from a cold filesystem cache
+        results = [measure_import(module) for _ in range(3)]
+        for deferred in DEFERRED_MODULES:
+            self.assertNotIn(deferred, results[0]['modules'], 'importing %s imported %s' % (module, deferred))
+        best = min(r['elapsed'] for r in results)
+        self.assertLess(best, IMPORT_TIME_BUDGET, 'importing %s took %.3fs' % (module, best))
+
+    def test_core_import_time(self):
+        self.check_import('rocker.core')
+
+    def test_cli_import_time(self):
+        self.check_import('rocker.cli')
@@ -16,11 +16,18 @@
 # under the License.
 
 import docker
+import io
+import os
 import pytest
+import tarfile
+import tempfile
 import unittest
+from unittest import mock
 
 
+from rocker import os_detector
 from rocker.os_detector import detect_os
+from rocker.os_detector import parse_os_release
 
 class RockerOSDetectorTest(unittest.TestCase):
 
@@ -55,3 +62,100 @@ class RockerOSDetectorTest(unittest.TestCase):
         # Test with output callback too get coverage of error reporting
         result = detect_os("scratch", output_callback=print)
         self.assertEqual(result, None)
+
+class RockerOSDetectorCacheTest(unittest.TestCase):
+
+    class FakeDockerClient:
+        def __init__(self, image_id):
+            self.image_id = image_id
+
+        def inspect_image(self, image):
+            return {'Id': self.image_id}
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env_patch = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_dir.name})
+        self.env_patch.start()
+        os_detector._detect_os_cache.clear()
+
+    def tearDown(self):
+        self.env_patch.stop()
+        self.cache_dir.cleanup()
+        os_detector._detect_os_cache.clear()
+
+    def test_persistent_cache(self):
+        client = self.FakeDockerClient('sha256:aaaa')
+        with mock.patch('rocker.os_detector._run_detection', return_value=('Ubuntu', '22.04', 'jammy')) as run_detection:
+            self.assertEqual(detect_os('ubuntu:jammy', docker_client=client), ('Ubuntu', '22.04', 'jammy'))
+            self.assertEqual(run_detection.call_count, 1)
+            # Simulate a new process, the result should come from disk
+            os_detector._detect_os_cache.clear()
+            self.assertEqual(detect_os('ubuntu:jammy', docker_client=client), ('Ubuntu', '22.04', 'jammy'))
+            self.assertEqual(run_detection.call_count, 1)
+            # nocache forces detection
+            detect_os('ubuntu:jammy', docker_client=client, nocache=True)
+            self.assertEqual(run_detection.call_count, 2)
+
+    def test_cache_invalidated_by_new_digest(self):
+        with mock.patch('rocker.os_detector._run_detection', return_value=('Ubuntu', '22.04', 'jammy')):
+            detect_os('ubuntu:latest', docker_client=self.FakeDockerClient('sha256:aaaa'))
+        os_detector._detect_os_cache.clear()
+        with mock.patch('rocker.os_detector._run_detection', return_value=('Ubuntu', '24.04', 'noble')) as run_detection:
+            result = detect_os('ubuntu:latest', docker_client=self.FakeDockerClient('sha256:bbbb'))
+            self.assertEqual(run_detection.call_count, 1)
+        self.assertEqual(result, ('Ubuntu', '24.04', 'noble'))
+
+
+UBUNTU_OS_RELEASE = '''PRETTY_NAME="Ubuntu 22.04.4 LTS"
+NAME="Ubuntu"
+VERSION_ID="22.04"
+VERSION="22.04.4 LTS (Jammy Jellyfish)"
+VERSION_CODENAME=jammy
+ID=ubuntu
+ID_LIKE=debian
+UBUNTU_CODENAME=jammy
+'''
+
+
+class RockerOSReleaseTest(unittest.TestCase):
+
+    class FakeDockerClient:
+        """Serves an image where /etc/os-release is a relative symlink as on Ubuntu"""
+        def __init__(self):
+            self.removed = []
+
+        def create_container(self, image, command=None):
+            return {'Id': 'container1'}
+
+        def remove_container(self, container, force=False):
+            self.removed.append(container)
+
+        def get_archive(self, container, path):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w') as tar:
+                info = tarfile.TarInfo(os.path.basename(path))
+                if path == '/etc/os-release':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = '../usr/lib/os-release'
+                    tar.addfile(info)
+                elif path == '/usr/lib/os-release':
+                    data = UBUNTU_OS_RELEASE.encode()
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                else:
+                    raise docker.errors.NotFound('missing')
+            return [buf.getvalue()], {}
+
+    def test_parse_os_release(self):
+        fields = parse_os_release(UBUNTU_OS_RELEASE + '# comment\n\nBROKEN_LINE\n')
+        self.assertEqual(fields['NAME'], 'Ubuntu')
+        self.assertEqual(fields['VERSION_ID'], '22.04')
+        self.assertEqual(fields['PRETTY_NAME'], 'Ubuntu 22.04.4 LTS')
+        self.assertEqual(fields['VERSION_CODENAME'], 'jammy')
+        self.assertNotIn('BROKEN_LINE', fields)
+
+    def test_detection_follows_symlink(self):
+        client = self.FakeDockerClient()
+        result = os_detector._run_detection('ubuntu:jammy', client, None)
+        self.assertEqual(result, ('Ubuntu', '22.04', 'jammy'))
+        self.assertEqual(client.removed, ['container1'])
@@ -55,16 +55,18 @@ class rmwExtensionTest(unittest.TestCase):
         self.assertEqual(p.get_preamble(mock_cliargs), '')
         args = p.get_docker_args(mock_cliargs)
         self.assertIn('-e RMW_IMPLEMENTATION=rmw_cyclonedds_cpp', args)
-        snippet = p.get_snippet(mock_cliargs)
-        self.assertIn('rmw-cyclonedds-cpp', snippet)
+        self.assertEqual(p.get_snippet(mock_cliargs), '')
+        packages = p.get_apt_packages(mock_cliargs)
+        self.assertEqual(len(packages), 1)
+        self.assertIn('rmw-cyclonedds-cpp', packages[0])
+        self.assertIn('${ROS_DISTRO:?', packages[0])
 
 
         #without it set
         mock_cliargs = {'rmw': None}
         args = p.get_docker_args(mock_cliargs)
-        snippet = p.get_snippet(mock_cliargs)
         self.assertNotIn('RMW_IMPLEMENTATION', args)
-        self.assertNotIn('rmw-cyclonedds-cpp', snippet)
+        self.assertEqual(p.get_apt_packages(mock_cliargs), [])
 
 
 @pytest.mark.docker